@@ -0,0 +1,332 @@
+"""
+中医智能体评测脚本
+
+读取 case/extracted_cases.json，对每个病例运行 症状提取 → 病证诊断 → 给方 流程，
+并与 result 中的参考答案比较，同时记录每个病例的 LLM 调用次数、token 用量与耗时，
+便于在质量与成本之间调节 max_retries / max_cycles / max_steps。
+
+评分项：
+- disease_match: 病名是否与参考诊断一致
+- syndrome_match: 证型是否与参考诊断一致
+- herb_precision / herb_recall: 处方药物集合相对参考处方的精确率与召回率
+  （参考答案含多次就诊或外用方时，只与各内服方分别比较，取最优者）
+- has_contraindication: 生成处方中是否存在"十八反、十九畏"配伍禁忌（未生成处方时为 None）
+
+用法：
+    python evaluate.py --workers 4 --limit 10 --output eval.jsonl
+    python evaluate.py --store .stage_cache    # 增量模式：修改提示词后只重算受影响的阶段
+    python evaluate.py --lane batch            # 批量重跑走 batch 通道，让出交互请求的并发名额
+    python evaluate.py --quiet --log events.jsonl   # 不输出过程信息，事件只写入 JSONL
+"""
+
+import sys
+import os
+import re
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+# 添加 scr 目录到路径
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scr'))
+
+from agent import tcm_sydrom_agent
+from agent import tcm_diagnosis_agent
+from agent import tcm_treatment_agent
+from agent import get_fast_path_stats
+from llm import LANES, track_usage, priority_lane, usage_shares, get_stats
+from rules import normalize_herb, parse_herbs, find_contraindications
+from dag import StageStore, build_tcm_graph
+from events import LEVELS, configure, event_tags, flush, get_event_stats
+
+DEFAULT_CASES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'case', 'extracted_cases.json')
+
+# 作为智能体输入的病例字段
+QUERY_FIELDS = ("tcm_check", "tcm_evidence")
+
+# 参考处方中外用方（熏洗、膏方、外敷等）的标记，这些方剂不参与药物集合比较
+EXTERNAL_MARKERS = ("外用", "熏洗", "膏", "外敷", "泡洗", "泡脚")
+
+
+def parse_reference_diagnoses(text: str) -> list:
+    """
+    从参考诊断文本中解析中医诊断，返回 [(病名, 证型), ...]
+
+    例如 "中医：1、燥痹-阴虚内热证；西医：1、干燥综合征[舍格伦]" → [("燥痹", "阴虚内热证")]
+    """
+    results = []
+    for segment in re.findall(r"中医：([^；;]*)", text or ""):
+        for item in re.split(r"\d+[、.]", segment):
+            item = item.strip(" ，,。")
+            if "-" not in item:
+                continue
+            disease, syndrome = item.split("-", 1)
+            results.append((disease.strip(), syndrome.strip()))
+    return results
+
+
+def _normalize_syndrome(syndrome: str) -> str:
+    return (syndrome or "").strip().rstrip("证")
+
+
+def score_diagnosis(predicted: str, reference_text: str) -> dict:
+    """比较预测诊断（"病名-证型"）与参考诊断，参考中无中医诊断时返回 None 分数"""
+    references = parse_reference_diagnoses(reference_text)
+    if not references:
+        return {"disease_match": None, "syndrome_match": None}
+
+    disease, _, syndrome = (predicted or "").partition("-")
+    disease_match = any(disease.strip() == ref_disease for ref_disease, _ in references)
+    syndrome_match = any(
+        _normalize_syndrome(syndrome) == _normalize_syndrome(ref_syndrome)
+        for _, ref_syndrome in references
+    )
+    return {"disease_match": disease_match, "syndrome_match": syndrome_match}
+
+
+def _prescription_herbs(treatment: dict) -> list:
+    herbs = []
+    for item in (treatment or {}).get("final_prescription") or []:
+        if isinstance(item, dict) and item.get("herb"):
+            herbs.append(item["herb"])
+        elif isinstance(item, str):
+            herbs.append(item)
+    return herbs
+
+
+def reference_prescriptions(text: str) -> list:
+    """
+    将参考处方文本按句拆分为各内服方的药物集合
+
+    参考答案可能包含多次就诊的处方以及外用熏洗方/膏方，整体解析会把它们混为一方。
+    这里按"。"/"；"分段，去掉含外用标记的段落，返回每个含药物的段落的归一化药名集合。
+    """
+    prescriptions = []
+    for segment in re.split(r"[。；;]", text or ""):
+        if any(marker in segment for marker in EXTERNAL_MARKERS):
+            continue
+        herbs = {normalize_herb(h) for h, _ in parse_herbs(segment)}
+        if herbs:
+            prescriptions.append(herbs)
+    return prescriptions
+
+
+def score_prescription(treatment: dict, reference_text: str) -> dict:
+    """计算处方药物集合相对参考内服方的精确率/召回率（多方时取 F1 最高者），以及配伍禁忌情况"""
+    herbs = _prescription_herbs(treatment)
+    contraindications = find_contraindications(herbs)
+    scores = {
+        "herb_precision": None,
+        "herb_recall": None,
+        # 未生成处方时不计入配伍禁忌率
+        "has_contraindication": bool(contraindications) if herbs else None,
+        "contraindications": contraindications,
+    }
+
+    references = reference_prescriptions(reference_text)
+    if not references:
+        return scores
+
+    predicted = {normalize_herb(h) for h in herbs}
+    best = None
+    for reference in references:
+        hits = len(predicted & reference)
+        precision = hits / len(predicted) if predicted else 0.0
+        recall = hits / len(reference)
+        f1 = 2 * precision * recall / (precision + recall) if hits else 0.0
+        if best is None or (f1, recall) > best[0]:
+            best = ((f1, recall), precision, recall)
+    scores["herb_precision"], scores["herb_recall"] = best[1], best[2]
+    return scores
+
+
+def evaluate_case(index: int, case: dict, extract_retries: int, max_retries: int,
+                  max_cycles: int, max_steps: int, n_candidates: int = 1,
+                  graph=None, store=None, fast_path: bool = False, lane: str = "batch") -> dict:
+    """
+    运行单个病例并返回评分与成本记录
+
+    提供 graph 与 store 时按阶段DAG增量执行（只重算指纹变化的阶段），
+    此时 max_cycles / max_steps 不生效。病例的所有 LLM 调用都在 lane 通道中排队。
+    """
+    query = {k: case["query"][k] for k in QUERY_FIELDS if case.get("query", {}).get(k)}
+    result = case.get("result", {})
+    record = {"index": index, "source_file": case.get("source_file", "")}
+
+    start = time.perf_counter()
+    with track_usage() as usage, priority_lane(lane), event_tags(case=index):
+        try:
+            if graph is not None:
+                outputs, record["stages"] = graph.run(query, store)
+                diagnosis = outputs["diagnosis"]
+                treatment = (outputs["treatment"] or {}).get("prescription", {})
+            else:
+                symptoms = tcm_sydrom_agent(query, max_retries=extract_retries, n_candidates=n_candidates)
+                diagnosis = tcm_diagnosis_agent(symptoms)
+                treatment = tcm_treatment_agent(symptoms, diagnosis, max_retries=max_retries,
+                                                max_cycles=max_cycles, max_steps=max_steps,
+                                                n_candidates=n_candidates, fast_path=fast_path)
+            record["error"] = None
+        except Exception as e:
+            diagnosis, treatment = {}, {}
+            record["error"] = repr(e)
+    record["wall_time"] = round(time.perf_counter() - start, 3)
+
+    record["predicted_diagnosis"] = diagnosis.get("tcm_diagnosis", "")
+    record.update(score_diagnosis(record["predicted_diagnosis"], result.get("diagnosis", "")))
+    record.update(score_prescription(treatment, result.get("tcm_treatment", "")))
+    record.update({
+        "llm_calls": usage["calls"],
+        "llm_errors": usage["errors"],
+        # 被单飞合并到其他病例请求上的调用数；llm_calls 只含实际发出的请求，
+        # 两者之和才是与并发度无关的逻辑调用数
+        "llm_coalesced": usage["coalesced"],
+        "prompt_tokens": usage["prompt_tokens"],
+        "completion_tokens": usage["completion_tokens"],
+        "total_tokens": usage["total_tokens"],
+        "llm_latency": round(usage["latency"], 3),
+        "by_model": usage["by_model"],
+    })
+    return record
+
+
+def _mean(values: list):
+    values = [float(v) for v in values if v is not None]
+    return round(sum(values) / len(values), 4) if values else None
+
+
+def _percentile(values: list, q: float):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def _merge_by_model(records: list) -> dict:
+    """合并各病例按模型拆分的用量，并计算各档位的 token 与耗时占比"""
+    merged = {"total_tokens": 0, "latency": 0.0, "by_model": {}}
+    for r in records:
+        merged["total_tokens"] += r["total_tokens"]
+        merged["latency"] += r["llm_latency"]
+        for model, item in r["by_model"].items():
+            bucket = merged["by_model"].setdefault(model, dict.fromkeys(item, 0))
+            for key, value in item.items():
+                bucket[key] += value
+    return usage_shares(merged)
+
+
+def _stage_report(records: list) -> dict:
+    """统计DAG模式下各阶段复用（hit）与重算（run）的病例数"""
+    report = {}
+    for r in records:
+        for stage, status in (r.get("stages") or {}).items():
+            report.setdefault(stage, {"hit": 0, "run": 0})[status] += 1
+    return report
+
+
+def summarize(records: list) -> dict:
+    """汇总所有病例的质量与成本指标"""
+    wall_times = [r["wall_time"] for r in records]
+    return {
+        "cases": len(records),
+        "errors": sum(1 for r in records if r["error"]),
+        "disease_accuracy": _mean([r["disease_match"] for r in records]),
+        "syndrome_accuracy": _mean([r["syndrome_match"] for r in records]),
+        "herb_precision": _mean([r["herb_precision"] for r in records]),
+        "herb_recall": _mean([r["herb_recall"] for r in records]),
+        "contraindication_rate": _mean([r["has_contraindication"] for r in records]),
+        "llm_calls_per_case": _mean([r["llm_calls"] for r in records]),
+        "llm_coalesced_per_case": _mean([r["llm_coalesced"] for r in records]),
+        "llm_logical_calls_per_case": _mean([r["llm_calls"] + r["llm_coalesced"] for r in records]),
+        "total_coalesced": sum(r["llm_coalesced"] for r in records),
+        "tokens_per_case": _mean([r["total_tokens"] for r in records]),
+        "total_tokens": sum(r["total_tokens"] for r in records),
+        "wall_time_p50": _percentile(wall_times, 0.5),
+        "wall_time_p95": _percentile(wall_times, 0.95),
+        "by_model": _merge_by_model(records),
+        "stages": _stage_report(records),
+    }
+
+
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"必须为正整数: {value}")
+    return number
+
+
+def main():
+    parser = argparse.ArgumentParser(description="中医智能体质量/成本评测")
+    parser.add_argument("--cases", default=DEFAULT_CASES_PATH, help="病例文件路径")
+    parser.add_argument("--limit", type=int, default=None, help="只评测前 N 个病例")
+    parser.add_argument("--workers", type=int, default=4, help="并行评测的病例数")
+    parser.add_argument("--extract-retries", type=int, default=3, help="症状提取的最大重试次数")
+    parser.add_argument("--max-retries", type=int, default=2, help="给方单步调用的最大重试次数")
+    parser.add_argument("--max-cycles", type=_positive_int, default=3, help="给方校验的最大轮数（至少为 1）")
+    parser.add_argument("--max-steps", type=int, default=8, help="每轮 ReAct 的最大步数")
+    parser.add_argument("--candidates", type=int, default=1, help="每次调用的候选数量（>1 时以多候选代替串行重试）")
+    parser.add_argument("--fast-path", action="store_true",
+                        help="给方先尝试单次调用的快速通道，失败再回退到 ReAct（不能与 --store 同时使用）")
+    parser.add_argument("--store", default=None,
+                        help="阶段输出存储目录；指定后按阶段DAG增量执行，只重算提示词/输入/模型变化的阶段")
+    parser.add_argument("--lane", default="batch", choices=list(LANES), help="LLM 调用所属的优先级通道")
+    parser.add_argument("--output", default=None, help="逐病例结果输出路径（JSONL）")
+    parser.add_argument("--log", default=None, help="事件日志输出路径（JSONL，带 case/stage/cycle/step 标签）")
+    parser.add_argument("--log-level", default="info", choices=list(LEVELS), help="事件日志最低级别")
+    parser.add_argument("--quiet", action="store_true", help="不在控制台输出过程信息")
+    args = parser.parse_args()
+    if args.fast_path and args.store:
+        # 阶段DAG按子步骤逐一执行与缓存，不经过单次调用的快速通道
+        parser.error("--fast-path 不能与 --store 同时使用")
+
+    configure(args.log, args.log_level, args.quiet)
+
+    with open(args.cases, encoding="utf-8") as f:
+        cases = json.load(f)
+    if args.limit:
+        cases = cases[:args.limit]
+
+    graph = build_tcm_graph(args.extract_retries, args.max_retries, args.candidates) if args.store else None
+    store = StageStore(args.store) if args.store else None
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = [
+            pool.submit(evaluate_case, i, case, args.extract_retries, args.max_retries,
+                        args.max_cycles, args.max_steps, args.candidates, graph, store, args.fast_path, args.lane)
+            for i, case in enumerate(cases)
+        ]
+        records = [f.result() for f in futures]
+
+    summary = summarize(records)
+    summary["elapsed"] = round(time.perf_counter() - start, 3)
+    summary["limits"] = get_stats()["limits"]
+    summary["events"] = get_event_stats()
+    if args.fast_path:
+        summary["fast_path"] = get_fast_path_stats()
+    summary["config"] = {
+        "extract_retries": args.extract_retries,
+        "max_retries": args.max_retries,
+        "max_cycles": args.max_cycles,
+        "max_steps": args.max_steps,
+        "candidates": args.candidates,
+        "fast_path": args.fast_path,
+        "lane": args.lane,
+        "workers": args.workers,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            for r in records:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+
+    flush()
+    print("\n" + "=" * 50)
+    print("评测汇总：")
+    print("=" * 50)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    return summary
+
+
+if __name__ == "__main__":
+    main()
@@ -43,6 +43,7 @@ sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scr'))
 from agent import tcm_sydrom_agent
 from agent import tcm_diagnosis_agent
 from agent import tcm_treatment_agent
+from events import flush
 
 def main():
     # 测试用例
@@ -56,6 +57,7 @@ def main():
 
     # 1. 调用症状提取智能体
     symptoms = tcm_sydrom_agent(case)
+    flush()
     print("\n症状提取结果：")
     print(json.dumps(symptoms, ensure_ascii=False, indent=2))
 
@@ -64,6 +66,7 @@ def main():
     print("开始进行病证诊断...")
     print("=" * 50)
     diagnosis = tcm_diagnosis_agent(symptoms)
+    flush()
 
     print("\n" + "=" * 50)
     print("最终诊断结果：")
@@ -75,6 +78,7 @@ def main():
     print("开始给方（处方生成）流程...")
     print("=" * 50)
     treatment_result = tcm_treatment_agent(symptoms, diagnosis)
+    flush()
 
     print("\n处方生成结果（结构化）：")
     print(str(treatment_result))
@@ -3,11 +3,16 @@
 import json
 import sys
 import os
+import time
+import threading
 
 # 添加父目录到路径,以便导入同级模块
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from llm import call_llm
+import events
+from events import event_tags
+from llm import call_llm, call_llm_candidates, MODEL_TIERS, CANDIDATE_TEMPERATURE
+from rules import check_prescription, apply_patches
 from prompt import (
     EXTRACTION_SYSTEM_PROMPT,
     EXTRACTION_USER_PROMPT,
@@ -23,9 +28,214 @@ from prompt import (
     TREATMENT_OUTPUT_VALIDATION_SYSTEM_PROMPT,
     TREATMENT_OUTPUT_VALIDATION_PROMPT,
 )
+from prompt import (
+    TREATMENT_FAST_PATH_SYSTEM_PROMPT,
+    TREATMENT_FAST_PATH_USER_PROMPT,
+)
+from prompt import (
+    TREATMENT_REACT_SYSTEM_PROMPT,
+    TREATMENT_DETERMINE_PRINCIPLE_PROMPT,
+    TREATMENT_SELECT_BASE_PROMPT,
+    TREATMENT_PROPOSE_MODIFICATIONS_PROMPT,
+    TREATMENT_DETERMINE_DOSAGE_PROMPT,
+)
+
+# 合并 CoT 指导与 ReAct 系统提示（模块加载时构建一次）
+TREATMENT_SYSTEM_PROMPT = TREATMENT_COT_PROMPT + "\n" + TREATMENT_REACT_SYSTEM_PROMPT
+
+# 动作名称映射（用于更清晰的输出）
+ACTION_NAMES = {
+    "determine_principle": "确定治则",
+    "select_base_formula": "选择基础方",
+    "propose_modifications": "提出加减",
+    "determine_dosage": "确定用量",
+    "finish": "完成"
+}
+
+
+# 各阶段使用的模型档位（见 llm.MODEL_TIERS），可按阶段名修改。
+# small 档位的输出解析失败或未通过结构校验时，自动升级到 large 重新调用。
+STAGE_TIERS = {
+    "extraction": "large",
+    "validation": "small",
+    "diagnosis": "large",
+    "react": "small",
+    "determine_principle": "large",
+    "select_base_formula": "large",
+    "propose_modifications": "large",
+    "determine_dosage": "small",
+    "format_validation": "small",
+    "output_control": "large",
+    "fast_path": "large",
+}
+
+
+def _valid_dosage(res: dict) -> bool:
+    dosage = res.get("dosage")
+    return bool(dosage) and isinstance(dosage, list) and all(
+        isinstance(d, dict) and d.get("herb") and d.get("dose") for d in dosage
+    )
+
+
+# 各阶段输出的结构校验，用于判断是否需要升级模型
+STAGE_VALIDATORS = {
+    "extraction": lambda res: isinstance(res.get("inspection"), dict),
+    "validation": lambda res: isinstance(res.get("is_valid"), bool),
+    "diagnosis": lambda res: bool(res.get("tcm_diagnosis")),
+    "react": lambda res: res.get("action") in ACTION_NAMES,
+    "determine_principle": lambda res: bool(res.get("tcm_treatment_principle")),
+    "select_base_formula": lambda res: isinstance(res.get("base_formula"), dict) and bool(res["base_formula"].get("name")),
+    "propose_modifications": lambda res: isinstance(res.get("modifications"), list),
+    "determine_dosage": _valid_dosage,
+    "format_validation": lambda res: isinstance(res.get("valid"), bool),
+    "output_control": lambda res: isinstance(res.get("has_contraindication"), bool),
+    "fast_path": lambda res: isinstance(res.get("final_prescription"), list) and bool(res["final_prescription"]),
+}
+
+# 给方快速通道统计：尝试次数、命中次数，以及命中/回退两种情况下给方阶段的累计耗时
+_fast_path_lock = threading.Lock()
+_fast_path_stats = {"attempts": 0, "hits": 0, "fallbacks": 0, "hit_time": 0.0, "fallback_time": 0.0}
+
+
+def _record_fast_path(hit: bool, elapsed: float) -> None:
+    with _fast_path_lock:
+        _fast_path_stats["attempts"] += 1
+        if hit:
+            _fast_path_stats["hits"] += 1
+            _fast_path_stats["hit_time"] += elapsed
+        else:
+            _fast_path_stats["fallbacks"] += 1
+            _fast_path_stats["fallback_time"] += elapsed
+
+
+def get_fast_path_stats() -> dict:
+    """返回给方快速通道的命中率，以及命中与回退到 ReAct 时给方阶段的平均耗时（秒）"""
+    with _fast_path_lock:
+        stats = dict(_fast_path_stats)
+    stats["hit_rate"] = round(stats["hits"] / stats["attempts"], 4) if stats["attempts"] else 0.0
+    stats["avg_hit_time"] = round(stats["hit_time"] / stats["hits"], 3) if stats["hits"] else 0.0
+    stats["avg_fallback_time"] = round(stats["fallback_time"] / stats["fallbacks"], 3) if stats["fallbacks"] else 0.0
+    stats["hit_time"] = round(stats["hit_time"], 3)
+    stats["fallback_time"] = round(stats["fallback_time"], 3)
+    return stats
+
+
+def _call_stage(stage: str, messages: list, max_retries: int = 1,
+                n_candidates: int = 1, score=None) -> dict:
+    """
+    按阶段路由调用 LLM
+
+    先使用 STAGE_TIERS 中配置的档位；若为 small 档位且输出为空或未通过
+    STAGE_VALIDATORS 校验，则升级到 large 档位，最多重试 max_retries 次。
+    未通过校验的结果不写入缓存；large 档位的重试以 CANDIDATE_TEMPERATURE 采样，
+    避免以相同的确定性请求重复得到同一错误输出。
+
+    n_candidates > 1 时，每次调用在一次往返中获取多个候选（见 call_llm_candidates），
+    在通过校验的候选中选取 score 最高者（未提供 score 时取第一个），
+    以一次并行往返代替多次串行重试。
+
+    Returns:
+        LLM 返回的 JSON 字典；全部失败时返回最后一次结果（可能为空字典）
+    """
+    tier = STAGE_TIERS.get(stage, "large")
+    validate = STAGE_VALIDATORS.get(stage, bool)
+
+    def _accepted(res) -> bool:
+        return isinstance(res, dict) and bool(res) and validate(res)
+
+    def _call(cfg: dict, temperature: float = 0.0) -> dict:
+        if n_candidates <= 1:
+            return call_llm(messages, api_url=cfg["api_url"], model=cfg["model"],
+                            temperature=temperature, accept=_accepted)
+        candidates = call_llm_candidates(messages, n=n_candidates, api_url=cfg["api_url"], model=cfg["model"])
+        accepted = [c for c in candidates if _accepted(c)]
+        if not accepted:
+            return candidates[0] if candidates else {}
+        return max(accepted, key=score) if score else accepted[0]
+
+    with event_tags(stage=stage):
+        res = {}
+        if tier != "large":
+            cfg = MODEL_TIERS[tier]
+            res = _call(cfg)
+            if _accepted(res):
+                return res
+            events.warning("stage.escalate", "{model} 输出未通过校验，升级到 {to_model}",
+                           model=cfg["model"], to_model=MODEL_TIERS["large"]["model"])
+
+        cfg = MODEL_TIERS["large"]
+        for attempt in range(max(1, max_retries)):
+            res = _call(cfg, 0.0 if attempt == 0 else CANDIDATE_TEMPERATURE)
+            if _accepted(res):
+                return res
+        return res
+
+
+def _iter_extracted_items(result: dict):
+    """遍历提取结果中的所有症状条目"""
+    inspection = result.get("inspection") or {}
+    for key in ("mental_state", "voice", "breath"):
+        yield from inspection.get(key) or []
+    tongue = inspection.get("tongue") or {}
+    for key in ("tongue_body", "tongue_coating"):
+        if tongue.get(key):
+            yield tongue[key]
+    yield from (result.get("palpation") or {}).get("pulse") or []
+    yield from result.get("subjective_symptoms") or []
+    yield from result.get("oral_findings") or []
+
+
+# 原文出现关键字时，提取结果中应有对应部分（关键字, 判断该部分非空的函数）
+_EXPECTED_SECTIONS = (
+    ("舌", lambda res: bool((res["inspection"].get("tongue") or {}).get("tongue_body")
+                           or (res["inspection"].get("tongue") or {}).get("tongue_coating"))),
+    ("脉", lambda res: bool((res.get("palpation") or {}).get("pulse"))),
+    ("神", lambda res: bool(res["inspection"].get("mental_state"))),
+)
+
 
+def _is_grounded(item: str, source_text: str) -> bool:
+    # 拆分后的条目（如"眼鼻干燥"→"眼干"）不一定原样出现，逐字出现也视为有依据
+    return item in source_text or all(ch in source_text for ch in item)
 
-def tcm_sydrom_agent(case_dict: dict, max_retries: int = 3) -> dict:
+
+def _score_extraction(result: dict, source_text: str) -> float:
+    """
+    本地打分提取结果：结构不符合 schema 时为 0，否则为 有据率 × 覆盖率
+
+    有据率为可在原文中找到依据的条目比例；覆盖率为原文提及舌象、脉象、神志时
+    结果中对应部分非空的比例，以及是否提取到自觉症状。只提取少数条目的稀疏结果
+    覆盖率低，不会因全部条目有据而胜出。
+
+    Args:
+        result: 提取结果
+        source_text: 原始文本
+
+    Returns:
+        0~1 之间的分数
+    """
+    inspection = result.get("inspection")
+    if not isinstance(inspection, dict) or not isinstance(inspection.get("tongue", {}), dict):
+        return 0.0
+    list_fields = [inspection.get(k, []) for k in ("mental_state", "voice", "breath")]
+    list_fields.append((result.get("palpation") or {}).get("pulse", []))
+    list_fields.append(result.get("subjective_symptoms", []))
+    list_fields.append(result.get("oral_findings", []))
+    if not all(isinstance(f, list) for f in list_fields):
+        return 0.0
+
+    items = [str(item) for item in _iter_extracted_items(result) if item]
+    if not items:
+        return 0.0
+    grounding = sum(1 for item in items if _is_grounded(item, source_text)) / len(items)
+
+    checks = [present(result) for keyword, present in _EXPECTED_SECTIONS if keyword in source_text]
+    checks.append(bool(result.get("subjective_symptoms")))
+    coverage = sum(checks) / len(checks)
+    return grounding * coverage
+
+
+def tcm_sydrom_agent(case_dict: dict, max_retries: int = 3, n_candidates: int = 1) -> dict:
     """
     中医诊断信息提取智能体
 
@@ -39,6 +249,8 @@ def tcm_sydrom_agent(case_dict: dict, max_retries: int = 3) -> dict:
                 "tcm_evidence": "患者素体禀赋不足..."
             }
         max_retries: 最大重试次数，默认为3
+        n_candidates: 每次提取的候选数量，大于1时一次往返获取多个候选，
+            按本地打分（同分时条目多者优先）选优后仍经验证LLM检查遗漏
 
     Returns:
         结构化的症状信息字典，格式如下：
@@ -78,13 +290,16 @@ def tcm_sydrom_agent(case_dict: dict, max_retries: int = 3) -> dict:
 
     # 3. 循环提取和验证
     for attempt in range(max_retries):
-        print(f"第 {attempt + 1} 次提取尝试...")
+        events.info("extraction.attempt", "第 {attempt} 次提取尝试...", stage="extraction", attempt=attempt + 1)
 
         # 调用提取LLM
-        extracted_result = call_llm(extraction_messages)
+        extracted_result = _call_stage(
+            "extraction", extraction_messages, n_candidates=n_candidates,
+            score=lambda res: (_score_extraction(res, combined_text), sum(1 for _ in _iter_extracted_items(res)))
+        )
 
         if not extracted_result:
-            print("提取失败，重试中...")
+            events.warning("extraction.failed", "提取失败，重试中...", stage="extraction", attempt=attempt + 1)
             continue
 
         # 构建验证消息
@@ -97,22 +312,20 @@ def tcm_sydrom_agent(case_dict: dict, max_retries: int = 3) -> dict:
         ]
 
         # 调用验证LLM
-        print("正在验证提取结果...")
-        validation_result = call_llm(validation_messages)
+        events.info("validation.start", "正在验证提取结果...", stage="validation", attempt=attempt + 1)
+        validation_result = _call_stage("validation", validation_messages)
 
         # 检查验证结果
         if validation_result.get("is_valid", False):
-            print("验证通过！")
+            events.info("validation.passed", "验证通过！", stage="validation", attempt=attempt + 1)
             return extracted_result
 
-        # 验证失败，输出问题
-        print(f"验证未通过:")
-        if validation_result.get("missing_items"):
-            print(f"  - 遗漏项: {validation_result['missing_items']}")
-        if validation_result.get("wrong_items"):
-            print(f"  - 错误项: {validation_result['wrong_items']}")
-        if validation_result.get("suggestions"):
-            print(f"  - 建议: {validation_result['suggestions']}")
+        # 验证失败，记录问题
+        events.warning("validation.failed", "验证未通过: 遗漏项 {missing_items}，错误项 {wrong_items}，建议 {suggestions}",
+                       stage="validation", attempt=attempt + 1,
+                       missing_items=validation_result.get("missing_items") or [],
+                       wrong_items=validation_result.get("wrong_items") or [],
+                       suggestions=validation_result.get("suggestions") or "")
 
         # 如果还有重试机会，将问题反馈给提取LLM重新处理
         if attempt < max_retries - 1:
@@ -136,7 +349,8 @@ def tcm_sydrom_agent(case_dict: dict, max_retries: int = 3) -> dict:
             })
 
     # 超过最大重试次数，返回最后一次的结果
-    print(f"已达到最大重试次数({max_retries})，返回当前结果")
+    events.warning("extraction.exhausted", "已达到最大重试次数({max_retries})，返回当前结果",
+                   stage="extraction", max_retries=max_retries)
     return extracted_result
 
 def tcm_diagnosis_agent(case_dict: dict) -> dict:
@@ -159,243 +373,321 @@ def tcm_diagnosis_agent(case_dict: dict) -> dict:
     ]
 
     # 3. 直接调用LLM进行诊断
-    print("正在进行病证诊断...")
-    diagnosis_result = call_llm(diagnosis_messages)
+    events.info("diagnosis.start", "正在进行病证诊断...", stage="diagnosis")
+    diagnosis_result = _call_stage("diagnosis", diagnosis_messages)
 
     if diagnosis_result and "tcm_diagnosis" in diagnosis_result:
-        print(f"诊断完成：{diagnosis_result['tcm_diagnosis']}")
+        events.info("diagnosis.done", "诊断完成：{tcm_diagnosis}", stage="diagnosis",
+                    tcm_diagnosis=diagnosis_result["tcm_diagnosis"])
         if "think" in diagnosis_result:
-            print(f"推理过程：{diagnosis_result['think']}")
+            events.debug("diagnosis.think", "推理过程：{think}", stage="diagnosis", think=diagnosis_result["think"])
     else:
-        print("诊断失败，返回空结果")
+        events.error("diagnosis.failed", "诊断失败，返回空结果", stage="diagnosis")
         diagnosis_result = {"think": "", "tcm_diagnosis": ""}
 
     return diagnosis_result
 
-def tcm_treatment_agent(case_dict: dict, tcm_diagnosis: dict, max_retries: int = 2) -> dict:
+def determine_principle(tcm_diagnosis: dict, symptoms_text: str,
+                        max_retries: int = 2, n_candidates: int = 1) -> dict:
+    """确定治则/治法，返回 {"tcm_treatment_principle": "...", "think": "..."}"""
+    messages = [
+        {"role": "system", "content": TREATMENT_DETERMINE_PRINCIPLE_PROMPT},
+        {"role": "user", "content": f"辨病信息：{json.dumps(tcm_diagnosis, ensure_ascii=False)}\n病人主要症状：{symptoms_text}"}
+    ]
+    return _call_stage("determine_principle", messages, max_retries, n_candidates) or {}
+
+
+def select_base_formula(tcm_diagnosis: dict, treatment_principle: str, symptoms_text: str,
+                        max_retries: int = 2, n_candidates: int = 1) -> dict:
+    """推荐基础方，返回 {"base_formula": {"name", "source", "herbs"}, "think": "..."}"""
+    context = {"tcm_diagnosis": tcm_diagnosis, "treatment_principle": treatment_principle, "symptoms": symptoms_text}
+    messages = [
+        {"role": "system", "content": TREATMENT_SELECT_BASE_PROMPT},
+        {"role": "user", "content": f"输入：{json.dumps(context, ensure_ascii=False)}"}
+    ]
+    return _call_stage("select_base_formula", messages, max_retries, n_candidates) or {}
+
+
+def propose_modifications(symptoms_text: str, tcm_diagnosis: dict, base_formula: dict,
+                          max_retries: int = 2, n_candidates: int = 1) -> dict:
+    """针对基础方提出加减，返回 {"modifications": [{"herb", "reason"}, ...], "think": "..."}"""
+    context = {"symptoms": symptoms_text, "tcm_diagnosis": tcm_diagnosis, "base_formula": base_formula}
+    messages = [
+        {"role": "system", "content": TREATMENT_PROPOSE_MODIFICATIONS_PROMPT},
+        {"role": "user", "content": f"输入：{json.dumps(context, ensure_ascii=False)}"}
+    ]
+    return _call_stage("propose_modifications", messages, max_retries, n_candidates) or {}
+
+
+def collect_herbs(base_formula: dict, modifications: list) -> list:
+    """合并基础方药物与加减药物（去重、保持顺序）"""
+    final_herbs = []
+    base_herbs = (base_formula or {}).get("herbs", []) or []
+    final_herbs.extend(base_herbs)
+    for m in modifications or []:
+        if isinstance(m, dict):
+            herb_name = m.get("herb")
+            if herb_name and herb_name not in final_herbs:
+                final_herbs.append(herb_name)
+    return final_herbs
+
+
+def determine_dosage(herbs: list, max_retries: int = 2, n_candidates: int = 1) -> dict:
+    """为药物列表确定用量与煎服法，返回 {"dosage": [{"herb", "dose"}, ...], "useway": "..."}"""
+    context = {"herbs": herbs}
+    messages = [
+        {"role": "system", "content": TREATMENT_DETERMINE_DOSAGE_PROMPT},
+        {"role": "user", "content": f"输入：{json.dumps(context, ensure_ascii=False)}"}
+    ]
+    return _call_stage("determine_dosage", messages, max_retries, n_candidates) or {}
+
+
+def standardize_prescription(final_prescription: dict, tcm_diagnosis: dict) -> dict:
+    """将 ReAct 过程中累积的处方整理为用于校验与输出的标准结构"""
+    base_name = ""
+    if isinstance(final_prescription.get("base_formula"), dict):
+        base_name = final_prescription["base_formula"].get("name", "")
+    elif isinstance(final_prescription.get("base_formula"), str):
+        base_name = final_prescription.get("base_formula")
+
+    dosage = final_prescription.get("dosage") or []
+    if isinstance(dosage, dict):
+        dosage = dosage.get("dosage", [])
+
+    # 保留 warnings（如果在 finish 步骤中生成了）
+    warnings = final_prescription.get("warnings", [])
+
+    return {
+        "tcm_diagnosis": tcm_diagnosis.get("tcm_diagnosis") if isinstance(tcm_diagnosis, dict) else str(tcm_diagnosis),
+        "treatment_principle": final_prescription.get("tcm_treatment_principle", ""),
+        "base_formula": base_name,
+        "final_prescription": dosage,
+        "useway": final_prescription.get("useway", ""),
+        "warnings": warnings
+    }
+
+
+def validate_prescription_format(standardized: dict, max_retries: int = 2) -> dict:
+    """调用 LLM 检查标准处方的格式与质量，返回 {"valid", "errors", "suggestions"}"""
+    val_messages = [
+        {"role": "system", "content": TREATMENT_OUTPUT_VALIDATION_SYSTEM_PROMPT},
+        {"role": "user", "content": TREATMENT_OUTPUT_VALIDATION_PROMPT.format(output=json.dumps(standardized, ensure_ascii=False))}
+    ]
+    return _call_stage("format_validation", val_messages, max_retries) or {"valid": False, "errors": ["校验失败"]}
+
+
+def fast_treatment(tcm_diagnosis: dict, symptoms_text: str, max_retries: int = 2) -> tuple:
+    """
+    给方快速通道：一次结构化调用直接生成完整的标准处方，并用本地规则校验
+
+    Returns:
+        (标准处方, 本地校验问题列表)；问题列表为空表示可直接采用
+    """
+    messages = [
+        {"role": "system", "content": TREATMENT_FAST_PATH_SYSTEM_PROMPT},
+        {"role": "user", "content": TREATMENT_FAST_PATH_USER_PROMPT.format(
+            tcm_diagnosis=json.dumps(tcm_diagnosis, ensure_ascii=False),
+            symptoms=symptoms_text
+        )}
+    ]
+    res = _call_stage("fast_path", messages, max_retries) or {}
+    if not isinstance(res, dict):
+        res = {}
+
+    standardized = standardize_prescription({
+        "tcm_treatment_principle": res.get("treatment_principle", ""),
+        "base_formula": res.get("base_formula", {}),
+        "dosage": res.get("final_prescription", []),
+        "useway": res.get("useway", ""),
+        "warnings": res.get("warnings", []) if isinstance(res.get("warnings"), list) else [],
+    }, tcm_diagnosis)
+    return standardized, check_prescription(standardized)
+
+
+def tcm_treatment_agent(case_dict: dict, tcm_diagnosis: dict, max_retries: int = 2,
+                        max_cycles: int = 3, max_steps: int = 8, n_candidates: int = 1,
+                        fast_path: bool = False) -> dict:
     """中医给方智能体（ReAct 风格）
 
     采用 ReAct 循环：LLM 每轮返回 {"thought", "action", "action_input"}，
     agent 执行 action（调用对应 prompt），把 observation 反馈回 LLM，直到 action 为 finish。
+
+    Args:
+        case_dict: 结构化的症状信息字典
+        tcm_diagnosis: 诊断结果（来自 tcm_diagnosis_agent 的输出）
+        max_retries: 单次 LLM 调用返回空结果时的最大重试次数
+        max_cycles: 校验未通过时重新生成处方的最大轮数，至少为 1
+        max_steps: 每轮 ReAct 的最大步数
+        n_candidates: ReAct 与各子步骤每次调用的候选数量，大于1时一次往返获取多个候选
+            并取第一个通过结构校验者（格式校验仍为单次确定性调用）
+        fast_path: 是否先尝试单次调用的快速通道（见 fast_treatment），
+            本地校验通过则直接返回，否则回退到 ReAct 流程
     """
+    if max_cycles < 1:
+        raise ValueError(f"max_cycles 至少为 1，当前为 {max_cycles}")
+
     # 组织病例文本用于 prompt
     symptoms_text = _format_symptoms(case_dict)
 
-    def _call_with_retry(messages):
-        for attempt in range(max_retries):
-            res = call_llm(messages)
-            if res:
-                return res
-        return {}
-
-    # 导入 ReAct 所需提示词
-    from prompt import (
-        TREATMENT_REACT_SYSTEM_PROMPT,
-        TREATMENT_DETERMINE_PRINCIPLE_PROMPT,
-        TREATMENT_SELECT_BASE_PROMPT,
-        TREATMENT_PROPOSE_MODIFICATIONS_PROMPT,
-        TREATMENT_DETERMINE_DOSAGE_PROMPT,
-    )
-
-    # 动作名称映射（用于更清晰的输出）
-    action_names = {
-        "determine_principle": "确定治则",
-        "select_base_formula": "选择基础方",
-        "propose_modifications": "提出加减",
-        "determine_dosage": "确定用量",
-        "finish": "完成"
-    }
+    if fast_path:
+        start = time.perf_counter()
+        events.info("fast_path.start", "快速通道给方中...", stage="fast_path")
+        standardized, errors = fast_treatment(tcm_diagnosis, symptoms_text, max_retries)
+        if not errors:
+            _record_fast_path(True, time.perf_counter() - start)
+            events.info("fast_path.accepted", "✓ 快速通道处方通过本地校验", stage="fast_path")
+            return standardized
+        events.warning("fast_path.fallback", "❌ 快速通道处方未通过本地校验，回退到 ReAct 流程：{errors}",
+                       stage="fast_path", errors=errors)
+        result = tcm_treatment_agent(case_dict, tcm_diagnosis, max_retries, max_cycles, max_steps, n_candidates)
+        _record_fast_path(False, time.perf_counter() - start)
+        return result
 
-    max_cycles = 3
     cycle_feedback = None
     val_res = {}
     oc_res = {}
 
     for cycle in range(max_cycles):
-        print(f"\n{'='*60}")
-        print(f"处方生成 第 {cycle+1} 轮")
-        print(f"{'='*60}")
-
-        # 合并 CoT 指导与 ReAct 系统提示
-        combined_system_prompt = TREATMENT_COT_PROMPT + "\n" + TREATMENT_REACT_SYSTEM_PROMPT
-
-        # 启动 ReAct 对话
-        react_messages = [
-            {"role": "system", "content": combined_system_prompt},
-            {"role": "user", "content": json.dumps({"tcm_diagnosis": tcm_diagnosis, "symptoms": symptoms_text}, ensure_ascii=False)}
-        ]
-
-        # 如果有上轮反馈，将其作为 assistant 内容注入，让模型据此修正
-        if cycle_feedback:
-            print(f"\n⚠️  上轮反馈：{cycle_feedback.get('type', '未知')}问题")
-            react_messages.append({"role": "user", "content": f"上一轮校验反馈：{json.dumps(cycle_feedback, ensure_ascii=False)}。请根据反馈调整处方。"})
-
-        # 执行 ReAct 流程，得到一次完整处方
-        final_prescription = {
-            "tcm_diagnosis": tcm_diagnosis,
-            "tcm_treatment_principle": "",
-            "base_formula": {},
-            "modifications": [],
-            "dosage": [],
-            "useway": "",
-            "warnings": []  # 初始化 warnings
-        }
-
-        max_steps = 8
-        for step_idx in range(max_steps):
-            react_res = _call_with_retry(react_messages)
-            if not isinstance(react_res, dict):
-                print("❌ LLM 未返回有效 JSON，终止 ReAct 流程")
-                break
-
-            action = react_res.get("action")
-            thought = react_res.get("thought", "")
-            action_input = react_res.get("action_input", {}) or {}
-
-            # 输出当前步骤信息
-            action_display = action_names.get(action, action)
-            print(f"\n第 {step_idx+1} 步：{action_display}")
-            if thought:
-                print(f"  思考：{thought}")
-
-            observation = {}
-
-            if action == "determine_principle":
-                messages = [
-                    {"role": "system", "content": TREATMENT_DETERMINE_PRINCIPLE_PROMPT},
-                    {"role": "user", "content": f"辨病信息：{json.dumps(tcm_diagnosis, ensure_ascii=False)}\n病人主要症状：{symptoms_text}"}
-                ]
-                observation = _call_with_retry(messages) or {}
-                final_prescription["tcm_treatment_principle"] = observation.get("tcm_treatment_principle", "")
-                print(f"  结果：{final_prescription['tcm_treatment_principle']}")
-
-            elif action == "select_base_formula":
-                context = {"tcm_diagnosis": tcm_diagnosis, "treatment_principle": final_prescription.get("tcm_treatment_principle", ""), "symptoms": symptoms_text}
-                messages = [
-                    {"role": "system", "content": TREATMENT_SELECT_BASE_PROMPT},
-                    {"role": "user", "content": f"输入：{json.dumps(context, ensure_ascii=False)}"}
-                ]
-                observation = _call_with_retry(messages) or {}
-                final_prescription["base_formula"] = observation.get("base_formula", {})
-                base_name = final_prescription["base_formula"].get("name", "")
-                print(f"  结果：{base_name}")
-
-            elif action == "propose_modifications":
-                context = {"symptoms": symptoms_text, "tcm_diagnosis": tcm_diagnosis, "base_formula": final_prescription.get("base_formula", {})}
-                messages = [
-                    {"role": "system", "content": TREATMENT_PROPOSE_MODIFICATIONS_PROMPT},
-                    {"role": "user", "content": f"输入：{json.dumps(context, ensure_ascii=False)}"}
-                ]
-                observation = _call_with_retry(messages) or {}
-                final_prescription["modifications"] = observation.get("modifications", [])
-                mod_count = len(final_prescription["modifications"])
-                print(f"  结果：提出 {mod_count} 处加减")
-
-            elif action == "determine_dosage":
-                final_herbs = []
-                base_herbs = final_prescription.get("base_formula", {}).get("herbs", []) or []
-                final_herbs.extend(base_herbs)
-                for m in final_prescription.get("modifications", []):
-                    if isinstance(m, dict):
-                        herb_name = m.get("herb")
-                        if herb_name and herb_name not in final_herbs:
-                            final_herbs.append(herb_name)
-
-                context = {"herbs": final_herbs}
-                messages = [
-                    {"role": "system", "content": TREATMENT_DETERMINE_DOSAGE_PROMPT},
-                    {"role": "user", "content": f"输入：{json.dumps(context, ensure_ascii=False)}"}
-                ]
-                observation = _call_with_retry(messages) or {}
-                final_prescription["dosage"] = observation.get("dosage", [])
-                final_prescription["useway"] = observation.get("useway", "")
-                print(f"  结果：确定 {len(final_prescription['dosage'])} 味药用量")
-
-            elif action == "finish":
-                final_summary = action_input or {}
-                for k in ("tcm_treatment_principle", "base_formula", "modifications", "dosage", "useway", "warnings"):
-                    if k in final_summary and final_summary[k]:
-                        final_prescription[k] = final_summary[k]
-                print(f"  结果：处方生成完成")
-                break
-
-            else:
-                print(f"❌ 未知动作: {action}，终止")
-                break
-
-            react_messages.append({"role": "assistant", "content": json.dumps(react_res, ensure_ascii=False)})
-            react_messages.append({"role": "user", "content": f'观测结果：{json.dumps(observation, ensure_ascii=False)}。请继续下一步（只返回 JSON: {{"thought":"...", "action":"...", "action_input":{{...}}}})。'})
-
-        # 将最终处方标准化为用于校验的结构
-        base_name = ""
-        if isinstance(final_prescription.get("base_formula"), dict):
-            base_name = final_prescription["base_formula"].get("name", "")
-        elif isinstance(final_prescription.get("base_formula"), str):
-            base_name = final_prescription.get("base_formula")
-
-        dosage = final_prescription.get("dosage") or []
-        if isinstance(dosage, dict):
-            dosage = dosage.get("dosage", [])
-
-        # 保留 warnings（如果在 finish 步骤中生成了）
-        warnings = final_prescription.get("warnings", [])
-
-        standardized = {
-            "tcm_diagnosis": tcm_diagnosis.get("tcm_diagnosis") if isinstance(tcm_diagnosis, dict) else str(tcm_diagnosis),
-            "treatment_principle": final_prescription.get("tcm_treatment_principle", ""),
-            "base_formula": base_name,
-            "final_prescription": dosage,
-            "useway": final_prescription.get("useway", ""),
-            "warnings": warnings
-        }
+        with event_tags(cycle=cycle + 1):
+            events.info("treatment.cycle", "处方生成 第 {cycle} 轮", cycle=cycle + 1)
+
+            # 启动 ReAct 对话
+            react_messages = [
+                {"role": "system", "content": TREATMENT_SYSTEM_PROMPT},
+                {"role": "user", "content": json.dumps({"tcm_diagnosis": tcm_diagnosis, "symptoms": symptoms_text}, ensure_ascii=False)}
+            ]
+
+            # 如果有上轮反馈，将其作为 assistant 内容注入，让模型据此修正
+            if cycle_feedback:
+                events.warning("treatment.feedback", "⚠️  上轮反馈：{type}问题",
+                               type=cycle_feedback.get("type", "未知"), detail=cycle_feedback.get("detail"))
+                react_messages.append({"role": "user", "content": f"上一轮校验反馈：{json.dumps(cycle_feedback, ensure_ascii=False)}。请根据反馈调整处方。"})
+
+            # 执行 ReAct 流程，得到一次完整处方
+            final_prescription = {
+                "tcm_diagnosis": tcm_diagnosis,
+                "tcm_treatment_principle": "",
+                "base_formula": {},
+                "modifications": [],
+                "dosage": [],
+                "useway": "",
+                "warnings": []  # 初始化 warnings
+            }
 
-        # 1) 格式与质量校验
-        print(f"\n{'─'*60}")
-        print("格式校验中...")
-        val_messages = [
-            {"role": "system", "content": TREATMENT_OUTPUT_VALIDATION_SYSTEM_PROMPT},
-            {"role": "user", "content": TREATMENT_OUTPUT_VALIDATION_PROMPT.format(output=json.dumps(standardized, ensure_ascii=False))}
-        ]
-        val_res = _call_with_retry(val_messages) or {"valid": False, "errors": ["校验失败"]}
+            for step_idx in range(max_steps):
+                with event_tags(step=step_idx + 1):
+                    react_res = _call_stage("react", react_messages, max_retries, n_candidates)
+                    if not isinstance(react_res, dict):
+                        events.error("react.invalid", "❌ LLM 未返回有效 JSON，终止 ReAct 流程")
+                        break
+
+                    action = react_res.get("action")
+                    thought = react_res.get("thought", "")
+                    action_input = react_res.get("action_input", {}) or {}
+
+                    # 记录当前步骤信息
+                    events.info("react.step", "第 {step} 步：{action_display}", step=step_idx + 1,
+                                action=action, action_display=ACTION_NAMES.get(action, action))
+                    if thought:
+                        events.debug("react.thought", "  思考：{thought}", thought=thought)
+
+                    observation = {}
+
+                    if action == "determine_principle":
+                        observation = determine_principle(tcm_diagnosis, symptoms_text, max_retries, n_candidates)
+                        final_prescription["tcm_treatment_principle"] = observation.get("tcm_treatment_principle", "")
+                        events.info("react.observation", "  结果：{result}", action=action,
+                                    result=final_prescription["tcm_treatment_principle"])
+
+                    elif action == "select_base_formula":
+                        observation = select_base_formula(
+                            tcm_diagnosis, final_prescription.get("tcm_treatment_principle", ""), symptoms_text,
+                            max_retries, n_candidates
+                        )
+                        final_prescription["base_formula"] = observation.get("base_formula", {})
+                        events.info("react.observation", "  结果：{result}", action=action,
+                                    result=final_prescription["base_formula"].get("name", ""))
+
+                    elif action == "propose_modifications":
+                        observation = propose_modifications(
+                            symptoms_text, tcm_diagnosis, final_prescription.get("base_formula", {}),
+                            max_retries, n_candidates
+                        )
+                        final_prescription["modifications"] = observation.get("modifications", [])
+                        events.info("react.observation", "  结果：提出 {count} 处加减", action=action,
+                                    count=len(final_prescription["modifications"]))
+
+                    elif action == "determine_dosage":
+                        final_herbs = collect_herbs(final_prescription.get("base_formula", {}), final_prescription.get("modifications", []))
+                        observation = determine_dosage(final_herbs, max_retries, n_candidates)
+                        final_prescription["dosage"] = observation.get("dosage", [])
+                        final_prescription["useway"] = observation.get("useway", "")
+                        events.info("react.observation", "  结果：确定 {count} 味药用量", action=action,
+                                    count=len(final_prescription["dosage"]))
+
+                    elif action == "finish":
+                        final_summary = action_input or {}
+                        for k in ("tcm_treatment_principle", "base_formula", "modifications", "dosage", "useway", "warnings"):
+                            if k in final_summary and final_summary[k]:
+                                final_prescription[k] = final_summary[k]
+                        events.info("react.observation", "  结果：处方生成完成", action=action)
+                        break
+
+                    else:
+                        events.error("react.unknown_action", "❌ 未知动作: {action}，终止", action=action)
+                        break
+
+                    react_messages.append({"role": "assistant", "content": json.dumps(react_res, ensure_ascii=False)})
+                    react_messages.append({"role": "user", "content": f'观测结果：{json.dumps(observation, ensure_ascii=False)}。请继续下一步（只返回 JSON: {{"thought":"...", "action":"...", "action_input":{{...}}}})。'})
+
+            # 将最终处方标准化为用于校验的结构
+            standardized = standardize_prescription(final_prescription, tcm_diagnosis)
+
+            # 1) 格式与质量校验
+            events.info("format_check.start", "格式校验中...", stage="format_validation")
+            val_res = validate_prescription_format(standardized, max_retries)
         
-        if not isinstance(val_res, dict) or not val_res.get("valid", False):
-            print("❌ 格式校验未通过")
-            cycle_feedback = {"type": "format", "detail": val_res}
-            continue
-        else:
-            print("✓ 格式校验通过")
+            if not isinstance(val_res, dict) or not val_res.get("valid", False):
+                events.warning("format_check.failed", "❌ 格式校验未通过", stage="format_validation", detail=val_res)
+                cycle_feedback = {"type": "format", "detail": val_res}
+                continue
+            else:
+                events.info("format_check.passed", "✓ 格式校验通过", stage="format_validation")
 
-        # 2) 输出安全校验
-        print("安全校验中...")
-        oc_res = output_control_agent(standardized)
+            # 2) 输出安全校验
+            events.info("safety_check.start", "安全校验中...", stage="output_control")
+            oc_res = output_control_agent(standardized)
         
-        if isinstance(oc_res, dict) and oc_res.get("has_contraindication"):
-            print("❌ 发现配伍禁忌")
-            cycle_feedback = {"type": "safety", "detail": oc_res}
-            continue
-        else:
-            print("✓ 安全校验通过")
-            # 合并安全校验返回的 warnings
-            if isinstance(oc_res, dict) and oc_res.get("warnings"):
-                standardized["warnings"].extend(oc_res["warnings"])
+            if isinstance(oc_res, dict) and oc_res.get("has_contraindication"):
+                events.warning("safety_check.contraindication", "❌ 发现配伍禁忌", stage="output_control",
+                               contraindications=oc_res.get("contraindications") or [])
+                corrected = correct_with_patches(standardized, oc_res)
+                if corrected is None:
+                    cycle_feedback = {"type": "safety", "detail": oc_res}
+                    continue
+                events.info("safety_check.patched", "✓ 已按安全校验补丁修正处方，本地复核通过", stage="output_control")
+                standardized = corrected
+            else:
+                events.info("safety_check.passed", "✓ 安全校验通过", stage="output_control")
+                # 合并安全校验返回的 warnings
+                if isinstance(oc_res, dict) and oc_res.get("warnings"):
+                    standardized["warnings"].extend(oc_res["warnings"])
 
-        # 若格式校验与安全校验都通过，返回最终结果
-        print(f"\n{'='*60}")
-        print("✓ 所有校验通过，处方生成成功")
-        print(f"{'='*60}\n")
-        return standardized
+            # 若格式校验与安全校验都通过，返回最终结果
+            events.info("treatment.done", "✓ 所有校验通过，处方生成成功")
+            return standardized
 
     # 达到最大循环次数仍未通过校验
-    print(f"\n{'='*60}")
-    print(f"⚠️  达到最大重试次数 ({max_cycles})，返回最后一次生成的处方")
-    print(f"{'='*60}\n")
+    events.warning("treatment.exhausted", "⚠️  达到最大重试次数 ({max_cycles})，返回最后一次生成的处方",
+                   max_cycles=max_cycles)
     return standardized
 
 
 def output_control_agent(prescription: dict) -> dict:
     """对处方进行基于"十八反、十九畏"以及常见安全问题的检查。
 
-    该函数调用 LLM（或本地规则）来判断是否存在明显配伍禁忌，返回可能的调整建议和用药警告。
+    该函数调用 LLM（或本地规则）来判断是否存在明显配伍禁忌，返回补丁形式的调整建议（patches）和用药警告，
+    不复述整张处方；补丁由 correct_with_patches 在本地应用并复核。
     返回格式与 `OUTPUT_CONTROL_USER_PROMPT` 中定义的 JSON 对齐。
     """
     # 构建检查消息并调用 LLM
@@ -409,21 +701,53 @@ def output_control_agent(prescription: dict) -> dict:
         {"role": "user", "content": user_content}
     ]
 
-    res = call_llm(messages)
+    res = _call_stage("output_control", messages)
 
     if not isinstance(res, dict):
         # 未得到结构化结果，返回空修改
         return {
-            "has_contraindication": False, 
-            "contraindications": [], 
-            "proposed_modifications": [], 
-            "warnings": [], 
-            "final_prescription": prescription.get("final_prescription", [])
+            "has_contraindication": False,
+            "contraindications": [],
+            "patches": [],
+            "warnings": []
         }
 
-    # 如果 LLM 返回 final_prescription 字段则使用它，否则保持原样
     return res
 
+
+def correct_with_patches(prescription: dict, oc_res: dict):
+    """
+    将安全校验返回的补丁应用到处方上，并用本地规则复核
+
+    Returns:
+        修正后的处方（已合并警告与修改说明）；无补丁、补丁无法应用或复核未通过时返回 None
+    """
+    patches = oc_res.get("patches") or []
+    if not isinstance(patches, list) or not patches:
+        return None
+
+    patched, applied, rejected = apply_patches(prescription, patches)
+    if rejected or not applied:
+        events.warning("safety_check.patch_rejected", "  补丁无法应用：{rejected}", rejected=rejected)
+        return None
+
+    errors = check_prescription(patched)
+    if errors:
+        events.warning("safety_check.recheck_failed", "  补丁应用后本地复核未通过：{errors}", errors=errors)
+        return None
+
+    notes = []
+    for patch in applied:
+        if patch.get("op") == "remove":
+            notes.append(f"去{patch['herb']}")
+        elif patch.get("op") == "replace":
+            notes.append(f"{patch['herb']}易为{patch['value']}")
+        else:
+            notes.append(f"{patch['herb']}减至{patch['value']}")
+    patched["warnings"] = list(prescription.get("warnings") or []) + list(oc_res.get("warnings") or [])
+    patched["warnings"].append(f"安全校验调整：{'、'.join(notes)}")
+    return patched
+
 def _format_symptoms(case_dict: dict) -> str:
     """将症状字典格式化为易读的文本"""
     parts = []
@@ -0,0 +1,258 @@
+"""阶段DAG执行模块 - 按输入指纹缓存各阶段输出，实现增量重算"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from llm import MODEL_TIERS
+from rules import find_contraindications
+from agent import (
+    STAGE_TIERS,
+    STAGE_VALIDATORS,
+    tcm_sydrom_agent,
+    tcm_diagnosis_agent,
+    determine_principle,
+    select_base_formula,
+    propose_modifications,
+    collect_herbs,
+    determine_dosage,
+    standardize_prescription,
+    validate_prescription_format,
+    output_control_agent,
+    correct_with_patches,
+    _format_symptoms,
+)
+from prompt import (
+    EXTRACTION_SYSTEM_PROMPT,
+    EXTRACTION_USER_PROMPT,
+    VALIDATION_SYSTEM_PROMPT,
+    VALIDATION_USER_PROMPT,
+    DIAGNOSIS_SYSTEM_PROMPT,
+    DIAGNOSIS_USER_PROMPT,
+    TREATMENT_DETERMINE_PRINCIPLE_PROMPT,
+    TREATMENT_SELECT_BASE_PROMPT,
+    TREATMENT_PROPOSE_MODIFICATIONS_PROMPT,
+    TREATMENT_DETERMINE_DOSAGE_PROMPT,
+    TREATMENT_OUTPUT_VALIDATION_SYSTEM_PROMPT,
+    TREATMENT_OUTPUT_VALIDATION_PROMPT,
+    OUTPUT_CONTROL_SYSTEM_PROMPT,
+    OUTPUT_CONTROL_USER_PROMPT,
+)
+
+
+class Stage:
+    """
+    DAG 中的一个阶段
+
+    Args:
+        name: 阶段名，同时作为下游阶段引用其输出的参数名
+        fn: 阶段函数，以依赖阶段的输出作为关键字参数调用
+        deps: 依赖的阶段名；"case" 表示原始病例输入
+        prompts: 阶段使用的提示词，内容变化即视为阶段变化
+        llm_stages: 阶段内调用 LLM 的路由名（见 agent.STAGE_TIERS），其模型或API地址
+            （含升级用的 large 档位）变化即视为阶段变化
+        params: 影响阶段输出的运行参数（重试次数、候选数量等），变化即视为阶段变化
+        accept: 判断阶段输出是否成功的函数，未通过的输出不写入存储，下次重新计算
+        version: 阶段代码版本，修改阶段逻辑时手动递增
+    """
+
+    def __init__(self, name: str, fn: Callable[..., Any], deps: Iterable[str] = (),
+                 prompts: Iterable[str] = (), llm_stages: Iterable[str] = (),
+                 params: Optional[Dict[str, Any]] = None, accept: Callable[[Any], bool] = bool,
+                 version: str = "1"):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.prompts = tuple(prompts)
+        self.llm_stages = tuple(llm_stages)
+        self.params = dict(params or {})
+        self.accept = accept
+        self.version = version
+
+    def models(self) -> List[Dict[str, Any]]:
+        """各 LLM 路由实际可能使用的 {api_url, model}：起始档位，以及校验失败时升级到的 large 档位"""
+        routes = []
+        for s in self.llm_stages:
+            tiers = sorted({STAGE_TIERS.get(s, "large"), "large"})
+            routes.append({"stage": s, "tiers": {t: dict(MODEL_TIERS[t]) for t in tiers}})
+        return routes
+
+    def fingerprint(self, inputs: Dict[str, Any]) -> str:
+        """由输入值、提示词、模型、运行参数与版本计算阶段指纹"""
+        blob = json.dumps({
+            "stage": self.name,
+            "version": self.version,
+            "inputs": inputs,
+            "prompts": self.prompts,
+            "models": self.models(),
+            "params": self.params,
+        }, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class StageStore:
+    """以 <root>/<stage>/<指纹前两位>/<指纹>.json 形式保存阶段输出的本地存储"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, stage: str, fingerprint: str) -> str:
+        return os.path.join(self.root, stage, fingerprint[:2], f"{fingerprint}.json")
+
+    def get(self, stage: str, fingerprint: str) -> Optional[Any]:
+        try:
+            with open(self._path(stage, fingerprint), encoding="utf-8") as f:
+                return json.load(f)["output"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, stage: str, fingerprint: str, output: Any) -> None:
+        path = self._path(stage, fingerprint)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"stage": stage, "fingerprint": fingerprint, "created": time.time(), "output": output},
+                      f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+
+class StageGraph:
+    """
+    阶段DAG执行器
+
+    每个阶段的输出按其指纹（输入值 + 提示词 + 模型 + 运行参数 + 版本）存入 StageStore。
+    再次运行时指纹未变的阶段直接复用存储结果；提示词或上游输出变化时，
+    只有受影响的阶段及输出随之变化的下游阶段会重新计算。
+    """
+
+    def __init__(self, stages: List[Stage]):
+        known = {"case"}
+        for stage in stages:
+            missing = [d for d in stage.deps if d not in known]
+            if missing:
+                raise ValueError(f"阶段 {stage.name} 依赖未定义的阶段: {missing}")
+            known.add(stage.name)
+        self.stages = stages
+
+    def run(self, case: dict, store: StageStore, force: Iterable[str] = ()) -> Tuple[Dict[str, Any], Dict[str, str]]:
+        """
+        对单个病例执行 DAG
+
+        Args:
+            case: 原始病例输入
+            store: 阶段输出存储
+            force: 强制重算的阶段名
+
+        Returns:
+            (各阶段输出, 各阶段执行情况 {"stage": "hit" | "run"})
+        """
+        force = set(force)
+        outputs: Dict[str, Any] = {"case": case}
+        report: Dict[str, str] = {}
+        for stage in self.stages:
+            inputs = {d: outputs[d] for d in stage.deps}
+            fp = stage.fingerprint(inputs)
+            cached = None if stage.name in force else store.get(stage.name, fp)
+            if cached is not None:
+                outputs[stage.name] = cached
+                report[stage.name] = "hit"
+                continue
+            output = stage.fn(**inputs)
+            # 未通过成功判断的输出不写入存储，下次重新计算
+            if stage.accept(output):
+                store.put(stage.name, fp, output)
+            outputs[stage.name] = output
+            report[stage.name] = "run"
+        outputs.pop("case")
+        return outputs, report
+
+
+def build_tcm_graph(extract_retries: int = 3, max_retries: int = 2, n_candidates: int = 1) -> StageGraph:
+    """
+    构建 症状提取 → 诊断 → 治则 → 基础方 → 加减 → 用量 → 处方校验 的阶段DAG
+
+    给方各子步骤按 CoT 提示词规定的顺序直接执行（不经 ReAct 控制器），
+    使每个子步骤成为可独立缓存、独立重算的阶段。
+    """
+
+    def _symptoms(case):
+        return tcm_sydrom_agent(case, max_retries=extract_retries, n_candidates=n_candidates)
+
+    def _diagnosis(symptoms):
+        return tcm_diagnosis_agent(symptoms)
+
+    def _principle(symptoms, diagnosis):
+        return determine_principle(diagnosis, _format_symptoms(symptoms), max_retries, n_candidates)
+
+    def _base_formula(symptoms, diagnosis, principle):
+        return select_base_formula(diagnosis, principle.get("tcm_treatment_principle", ""),
+                                   _format_symptoms(symptoms), max_retries, n_candidates)
+
+    def _modifications(symptoms, diagnosis, base_formula):
+        return propose_modifications(_format_symptoms(symptoms), diagnosis, base_formula.get("base_formula", {}),
+                                     max_retries, n_candidates)
+
+    def _dosage(base_formula, modifications):
+        herbs = collect_herbs(base_formula.get("base_formula", {}), modifications.get("modifications", []))
+        return determine_dosage(herbs, max_retries, n_candidates)
+
+    def _treatment(diagnosis, principle, base_formula, modifications, dosage):
+        standardized = standardize_prescription({
+            "tcm_treatment_principle": principle.get("tcm_treatment_principle", ""),
+            "base_formula": base_formula.get("base_formula", {}),
+            "modifications": modifications.get("modifications", []),
+            "dosage": dosage.get("dosage", []),
+            "useway": dosage.get("useway", ""),
+            "warnings": [],
+        }, diagnosis)
+        format_check = validate_prescription_format(standardized, max_retries)
+        safety_check = output_control_agent(standardized)
+        if isinstance(safety_check, dict) and safety_check.get("has_contraindication"):
+            standardized = correct_with_patches(standardized, safety_check) or standardized
+        elif isinstance(safety_check, dict) and safety_check.get("warnings"):
+            standardized["warnings"].extend(safety_check["warnings"])
+        return {"prescription": standardized, "format_check": format_check, "safety_check": safety_check}
+
+    def _validator(llm_stage: str) -> Callable[[Any], bool]:
+        validate = STAGE_VALIDATORS[llm_stage]
+        return lambda output: isinstance(output, dict) and bool(output) and validate(output)
+
+    def _treatment_ok(output) -> bool:
+        # 格式校验通过，且（补丁修正后的）处方中不存在配伍禁忌
+        if not isinstance(output, dict) or not (output.get("format_check") or {}).get("valid"):
+            return False
+        items = (output.get("prescription") or {}).get("final_prescription") or []
+        return not find_contraindications(item.get("herb") for item in items if isinstance(item, dict))
+
+    extract_params = {"extract_retries": extract_retries, "n_candidates": n_candidates}
+    step_params = {"max_retries": max_retries, "n_candidates": n_candidates}
+
+    return StageGraph([
+        Stage("symptoms", _symptoms, deps=("case",),
+              prompts=(EXTRACTION_SYSTEM_PROMPT, EXTRACTION_USER_PROMPT, VALIDATION_SYSTEM_PROMPT, VALIDATION_USER_PROMPT),
+              llm_stages=("extraction", "validation"), params=extract_params, accept=_validator("extraction")),
+        Stage("diagnosis", _diagnosis, deps=("symptoms",),
+              prompts=(DIAGNOSIS_SYSTEM_PROMPT, DIAGNOSIS_USER_PROMPT),
+              llm_stages=("diagnosis",), accept=_validator("diagnosis")),
+        Stage("principle", _principle, deps=("symptoms", "diagnosis"),
+              prompts=(TREATMENT_DETERMINE_PRINCIPLE_PROMPT,),
+              llm_stages=("determine_principle",), params=step_params, accept=_validator("determine_principle")),
+        Stage("base_formula", _base_formula, deps=("symptoms", "diagnosis", "principle"),
+              prompts=(TREATMENT_SELECT_BASE_PROMPT,),
+              llm_stages=("select_base_formula",), params=step_params, accept=_validator("select_base_formula")),
+        Stage("modifications", _modifications, deps=("symptoms", "diagnosis", "base_formula"),
+              prompts=(TREATMENT_PROPOSE_MODIFICATIONS_PROMPT,),
+              llm_stages=("propose_modifications",), params=step_params,
+              accept=_validator("propose_modifications")),
+        Stage("dosage", _dosage, deps=("base_formula", "modifications"),
+              prompts=(TREATMENT_DETERMINE_DOSAGE_PROMPT,),
+              llm_stages=("determine_dosage",), params=step_params, accept=_validator("determine_dosage")),
+        Stage("treatment", _treatment, deps=("diagnosis", "principle", "base_formula", "modifications", "dosage"),
+              prompts=(TREATMENT_OUTPUT_VALIDATION_SYSTEM_PROMPT, TREATMENT_OUTPUT_VALIDATION_PROMPT,
+                       OUTPUT_CONTROL_SYSTEM_PROMPT, OUTPUT_CONTROL_USER_PROMPT),
+              llm_stages=("format_validation", "output_control"), params={"max_retries": max_retries},
+              accept=_treatment_ok),
+    ])
@@ -0,0 +1,200 @@
+"""结构化事件日志模块 - 以 JSONL 记录各智能体的运行事件，由后台线程异步写出"""
+
+import sys
+import json
+import time
+import queue
+import atexit
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, TextIO
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error"}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+
+# 控制台输出时放在行首的标签（按此顺序）
+TAG_KEYS = ("case", "stage", "cycle", "step")
+
+# 高于任何级别，表示不记录任何事件
+_OFF = ERROR + 1
+
+_tags_var: contextvars.ContextVar = contextvars.ContextVar("event_tags", default={})
+
+# 低于该级别的事件在 emit 入口直接丢弃；无任何输出目标时为 _OFF
+_threshold = INFO
+_console: Optional[TextIO] = sys.stdout
+_file: Optional[TextIO] = None
+_queue: "queue.Queue" = queue.Queue(maxsize=10000)
+_writer: Optional[threading.Thread] = None
+_writer_lock = threading.Lock()
+_stats = {"emitted": 0, "dropped": 0, "written": 0}
+_STOP = object()
+
+
+@contextmanager
+def event_tags(**tags):
+    """
+    为上下文内的所有事件附加标签（case / stage / cycle / step 等），值为 None 的标签忽略
+
+    用法：
+        with event_tags(case=3):
+            tcm_treatment_agent(symptoms, diagnosis)
+    """
+    merged = dict(_tags_var.get())
+    merged.update((k, v) for k, v in tags.items() if v is not None)
+    token = _tags_var.set(merged)
+    try:
+        yield
+    finally:
+        _tags_var.reset(token)
+
+
+def configure(path: Optional[str] = None, level: str = "info", quiet: bool = False,
+              queue_size: int = 10000) -> None:
+    """
+    设置事件日志的输出目标与级别，应在开始处理病例前调用
+
+    Args:
+        path: JSONL 输出文件路径，None 表示不写文件
+        level: 最低记录级别（debug / info / warning / error）
+        quiet: 安静模式，不输出到控制台；未指定 path 时所有事件在入口处直接丢弃
+        queue_size: 待写事件队列的容量，队列满时新事件被丢弃并计数，调用方不会阻塞
+    """
+    global _threshold, _console, _file, _queue
+    if level not in LEVELS:
+        raise ValueError(f"未知的日志级别: {level}，可选: {list(LEVELS)}")
+    flush()
+    with _writer_lock:
+        if _file is not None:
+            _file.close()
+        _file = open(path, "a", encoding="utf-8") if path else None
+        _console = None if quiet else sys.stdout
+        _threshold = LEVELS[level] if (_console or _file) else _OFF
+        if _writer is None:
+            _queue = queue.Queue(maxsize=queue_size)
+
+
+def _ensure_writer() -> None:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = threading.Thread(target=_write_loop, name="event-writer", daemon=True)
+            _writer.start()
+
+
+def emit(level: int, event: str, msg: str = "", **fields) -> None:
+    """
+    记录一条事件（非阻塞）
+
+    调用方只构造事件字典并放入队列，消息格式化与写出都在后台线程完成。
+
+    Args:
+        level: 事件级别（DEBUG / INFO / WARNING / ERROR）
+        event: 事件名，如 "extraction.attempt"
+        msg: 控制台消息模板，以 fields 格式化，如 "第 {attempt} 次提取尝试..."
+        **fields: 事件字段，与当前上下文标签一起写入 JSONL
+    """
+    if level < _threshold:
+        return
+    if _writer is None:
+        _ensure_writer()
+    record = {"ts": time.time(), "level": level, "event": event, "msg": msg,
+              "tags": _tags_var.get(), "fields": fields}
+    try:
+        _queue.put_nowait(record)
+        _stats["emitted"] += 1
+    except queue.Full:
+        _stats["dropped"] += 1
+
+
+def debug(event: str, msg: str = "", **fields) -> None:
+    if DEBUG >= _threshold:
+        emit(DEBUG, event, msg, **fields)
+
+
+def info(event: str, msg: str = "", **fields) -> None:
+    if INFO >= _threshold:
+        emit(INFO, event, msg, **fields)
+
+
+def warning(event: str, msg: str = "", **fields) -> None:
+    if WARNING >= _threshold:
+        emit(WARNING, event, msg, **fields)
+
+
+def error(event: str, msg: str = "", **fields) -> None:
+    if ERROR >= _threshold:
+        emit(ERROR, event, msg, **fields)
+
+
+def _render(record: Dict[str, Any]) -> str:
+    try:
+        text = record["msg"].format(**record["fields"]) if record["msg"] else record["event"]
+    except (KeyError, IndexError, ValueError):
+        text = record["msg"]
+    tags = record["tags"]
+    prefix = " ".join(f"{k}={tags[k]}" for k in TAG_KEYS if k in tags)
+    return f"[{prefix}] {text}" if prefix else text
+
+
+def _write(record: Dict[str, Any]) -> None:
+    if _console is not None:
+        _console.write(_render(record) + "\n")
+        _console.flush()
+    if _file is not None:
+        line = {"ts": round(record["ts"], 3), "level": LEVEL_NAMES[record["level"]], "event": record["event"]}
+        line.update(record["tags"])
+        line.update(record["fields"])
+        if record["msg"]:
+            line["msg"] = _render(dict(record, tags={}))
+        _file.write(json.dumps(line, ensure_ascii=False, default=str) + "\n")
+
+
+def _write_loop() -> None:
+    while True:
+        record = _queue.get()
+        try:
+            if record is _STOP:
+                return
+            _write(record)
+            _stats["written"] += 1
+        except Exception:
+            # 写出失败不影响智能体运行
+            pass
+        finally:
+            if _file is not None and _queue.empty():
+                _file.flush()
+            _queue.task_done()
+
+
+def flush() -> None:
+    """等待已记录的事件全部写出"""
+    if _writer is not None and _writer.is_alive():
+        _queue.join()
+        if _file is not None:
+            _file.flush()
+
+
+def get_event_stats() -> Dict[str, int]:
+    """返回已记录、因队列满而丢弃、已写出的事件数（不加锁计数，为近似值），以及当前排队数"""
+    stats = dict(_stats)
+    stats["pending"] = _queue.qsize()
+    return stats
+
+
+@atexit.register
+def _shutdown() -> None:
+    if _writer is not None and _writer.is_alive():
+        try:
+            _queue.put(_STOP, timeout=1.0)
+            _writer.join(timeout=5.0)
+        except queue.Full:
+            pass
+    if _file is not None:
+        _file.flush()
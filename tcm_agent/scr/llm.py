@@ -1,14 +1,502 @@
 """大模型调用模块 - 提供统一的LLM调用接口"""
 
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import re
-from typing import List, Dict, Any, Optional
+import copy
+import time
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, List, Dict, Any, Optional
+
+import events
 
 
 # 默认API配置
 DEFAULT_API_URL = "http://129.227.88.34:19101/v1/chat/completions"
 DEFAULT_MODEL = "Qwen3-32B"
+SMALL_MODEL = "Qwen3-8B"
+
+# 多候选采样的默认温度
+CANDIDATE_TEMPERATURE = 0.7
+
+# 模型档位：large 为默认大模型，small 为低成本、低延迟的小模型
+MODEL_TIERS: Dict[str, Dict[str, str]] = {
+    "large": {"api_url": DEFAULT_API_URL, "model": DEFAULT_MODEL},
+    "small": {"api_url": DEFAULT_API_URL, "model": SMALL_MODEL},
+}
+
+# 共享HTTP连接池（线程安全，复用到推理服务的 keep-alive 连接）
+HTTP_POOL_SIZE = 32
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+
+# 当前上下文的调用统计（由 track_usage 设置）
+_usage_var: contextvars.ContextVar = contextvars.ContextVar("llm_usage", default=None)
+_usage_lock = threading.Lock()
+
+_USAGE_FIELDS = ("calls", "errors", "prompt_tokens", "completion_tokens", "total_tokens", "latency")
+
+
+def _new_usage() -> Dict[str, Any]:
+    usage: Dict[str, Any] = {key: 0 for key in _USAGE_FIELDS}
+    usage["latency"] = 0.0
+    usage["coalesced"] = 0
+    usage["by_model"] = {}
+    return usage
+
+
+# 进程级累计统计（供服务模式的 /metrics 使用）
+_global_usage: Dict[str, Any] = _new_usage()
+
+# 结果缓存（temperature=0 的 call_llm 调用），默认关闭，由 enable_cache 开启
+_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_config = {"maxsize": 0}
+_cache_stats = {"hits": 0, "misses": 0}
+
+
+def enable_cache(maxsize: int = 1024) -> None:
+    """
+    开启进程内 LRU 结果缓存，仅缓存 temperature=0 且解析成功的 call_llm 结果
+
+    Args:
+        maxsize: 最大缓存条目数，0 表示关闭缓存
+    """
+    with _cache_lock:
+        _cache_config["maxsize"] = max(0, maxsize)
+        while len(_cache) > _cache_config["maxsize"]:
+            _cache.popitem(last=False)
+
+
+def _cache_key(api_url: str, payload: Dict[str, Any]) -> str:
+    return api_url + "\n" + json.dumps(payload, ensure_ascii=False, sort_keys=True)
+
+
+def _cache_get(key: str) -> Optional[Dict[str, Any]]:
+    with _cache_lock:
+        if not _cache_config["maxsize"]:
+            return None
+        if key in _cache:
+            _cache.move_to_end(key)
+            _cache_stats["hits"] += 1
+            return copy.deepcopy(_cache[key])
+        _cache_stats["misses"] += 1
+        return None
+
+
+def _cache_put(key: str, value: Dict[str, Any]) -> None:
+    with _cache_lock:
+        if not _cache_config["maxsize"]:
+            return
+        _cache[key] = copy.deepcopy(value)
+        _cache.move_to_end(key)
+        while len(_cache) > _cache_config["maxsize"]:
+            _cache.popitem(last=False)
+
+
+class _Flight:
+    """一次进行中的请求，供相同请求键的并发调用方等待并共享结果"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.data: Optional[Dict[str, Any]] = None
+        self.error: Optional[BaseException] = None
+        self.followers = 0
+
+
+# 单飞（single-flight）：相同请求键的并发调用只发出一次 HTTP 请求
+_flights: Dict[str, _Flight] = {}
+_flight_lock = threading.Lock()
+_flight_stats = {"leaders": 0, "followers": 0}
+
+
+# 优先级通道：priority 越小越优先；share 为该通道最多可占用的并发上限比例
+LANES: Dict[str, Dict[str, float]] = {
+    "interactive": {"priority": 0, "share": 1.0},
+    "batch": {"priority": 1, "share": 0.75},
+}
+DEFAULT_LANE = "interactive"
+# 排队每满 AGING_SECONDS 秒，有效优先级提升一级，防止低优先级通道饿死
+AGING_SECONDS = 30.0
+
+_lane_var: contextvars.ContextVar = contextvars.ContextVar("llm_lane", default=DEFAULT_LANE)
+
+
+@contextmanager
+def priority_lane(lane: str):
+    """
+    指定上下文内 LLM 调用所属的优先级通道
+
+    用法：
+        with priority_lane("batch"):
+            tcm_treatment_agent(symptoms, diagnosis)
+    """
+    if lane not in LANES:
+        raise ValueError(f"未知的优先级通道: {lane}，可选: {list(LANES)}")
+    token = _lane_var.set(lane)
+    try:
+        yield
+    finally:
+        _lane_var.reset(token)
+
+
+class _Ticket:
+    """一个排队中的调用"""
+
+    __slots__ = ("lane", "priority", "enqueued", "seq")
+
+    def __init__(self, lane: str, seq: int):
+        self.lane = lane
+        self.priority = LANES[lane]["priority"]
+        self.enqueued = time.perf_counter()
+        self.seq = seq
+
+    def rank(self, now: float) -> tuple:
+        return (self.priority - (now - self.enqueued) / AGING_SECONDS, self.seq)
+
+
+class AdaptiveLimiter:
+    """
+    自适应并发限制器（AIMD + 延迟梯度）与优先级调度，按推理服务地址各自维护一个
+
+    - 请求成功且并发已接近上限时，上限加性增长（每个请求 +1/limit）
+    - 出现 429/5xx/超时/连接错误时，上限乘性减小（× backoff）
+    - 同一模型单位输出 token 的短期平均延迟明显高于其长期基线（> tolerance 倍）时，
+      说明后端开始排队，上限小幅减小（× 0.9）
+    超过上限的调用在队列中等待。有空闲名额时，按通道优先级（含排队时长带来的
+    老化提升）选出下一个调用。更高优先级的通道有调用在排队或进行中时，各通道占用
+    不超过其 share 比例；否则低优先级通道可用满全部名额。
+    """
+
+    def __init__(self, initial: int = 8, min_limit: int = 1, max_limit: int = HTTP_POOL_SIZE,
+                 backoff: float = 0.5, tolerance: float = 2.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.limit = float(initial)
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        # 各模型单位输出 token 延迟的短期/长期平均（同一地址可能部署多个模型，基线需分开）
+        self._fast: Dict[str, float] = {}
+        self._slow: Dict[str, float] = {}
+        self._stats = {"requests": 0, "overloads": 0, "increases": 0, "decreases": 0, "wait_time": 0.0}
+        self._queue: List[_Ticket] = []
+        self._seq = 0
+        self._lane_in_flight = {lane: 0 for lane in LANES}
+        self._lane_waits = {lane: deque(maxlen=1000) for lane in LANES}
+
+    @property
+    def waiting(self) -> int:
+        return len(self._queue)
+
+    def _lane_cap(self, lane: str) -> int:
+        priority = LANES[lane]["priority"]
+        contended = any(
+            self._lane_in_flight[other] > 0 or any(t.lane == other for t in self._queue)
+            for other, cfg in LANES.items() if cfg["priority"] < priority
+        )
+        if not contended:
+            return int(self.limit)
+        return max(1, int(int(self.limit) * LANES[lane]["share"]))
+
+    def _can_run(self, ticket: _Ticket) -> bool:
+        """名额未满、所属通道未超出份额，且是可运行的排队调用中优先级最高者"""
+        if self.in_flight >= int(self.limit):
+            return False
+        now = time.perf_counter()
+        eligible = [t for t in self._queue if self._lane_in_flight[t.lane] < self._lane_cap(t.lane)]
+        return bool(eligible) and min(eligible, key=lambda t: t.rank(now)) is ticket
+
+    def acquire(self, lane: str = DEFAULT_LANE) -> None:
+        """获取所属通道的一个并发名额，超过上限或未轮到时阻塞等待"""
+        with self._cond:
+            self._seq += 1
+            ticket = _Ticket(lane, self._seq)
+            self._queue.append(ticket)
+            while not self._can_run(ticket):
+                # 定时唤醒以便老化提升生效
+                self._cond.wait(timeout=1.0)
+            self._queue.remove(ticket)
+            self.in_flight += 1
+            self._lane_in_flight[lane] += 1
+            waited = time.perf_counter() - ticket.enqueued
+            self._lane_waits[lane].append(waited)
+            self._stats["requests"] += 1
+            self._stats["wait_time"] += waited
+            # 名额可能仍有空余，唤醒下一个排队者
+            self._cond.notify_all()
+
+    def release(self, latency: float, overloaded: bool = False, completion_tokens: int = 0,
+                lane: str = DEFAULT_LANE, model: str = "") -> None:
+        """
+        归还名额并根据本次结果调整上限
+
+        Args:
+            latency: 本次请求耗时（秒）
+            overloaded: 是否出现过载信号（429/5xx/超时/连接错误）
+            completion_tokens: 本次输出 token 数，用于归一化延迟；为 0 时不参与延迟梯度
+            lane: 获取名额时的通道
+            model: 本次请求的模型，延迟梯度按模型分别计算
+        """
+        with self._cond:
+            saturated = self.in_flight >= int(self.limit)
+            self.in_flight -= 1
+            self._lane_in_flight[lane] -= 1
+            if overloaded:
+                self._stats["overloads"] += 1
+                self._decrease(self.backoff)
+            elif completion_tokens > 0:
+                sample = latency / completion_tokens
+                fast = self._fast[model] = 0.5 * self._fast.get(model, sample) + 0.5 * sample
+                slow = self._slow[model] = 0.95 * self._slow.get(model, sample) + 0.05 * sample
+                if fast > slow * self.tolerance:
+                    self._decrease(0.9)
+                elif saturated:
+                    self._increase()
+            elif saturated:
+                self._increase()
+            self._cond.notify_all()
+
+    def _increase(self) -> None:
+        if self.limit < self.max_limit:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+            self._stats["increases"] += 1
+
+    def _decrease(self, factor: float) -> None:
+        if self.limit > self.min_limit:
+            self.limit = max(self.min_limit, self.limit * factor)
+            self._stats["decreases"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "wait_time": round(self._stats["wait_time"], 3),
+            })
+            lanes = {}
+            for lane in LANES:
+                waits = sorted(self._lane_waits[lane])
+                lanes[lane] = {
+                    "cap": self._lane_cap(lane),
+                    "in_flight": self._lane_in_flight[lane],
+                    "waiting": sum(1 for t in self._queue if t.lane == lane),
+                    "recent": len(waits),
+                    "wait_avg": round(sum(waits) / len(waits), 3) if waits else 0.0,
+                    "wait_p50": round(waits[int(0.5 * (len(waits) - 1))], 3) if waits else 0.0,
+                    "wait_p95": round(waits[int(0.95 * (len(waits) - 1))], 3) if waits else 0.0,
+                }
+            stats["lanes"] = lanes
+            return stats
+
+
+# 自适应并发限制器的初始参数（按API地址各建一个）
+LIMITER_CONFIG: Dict[str, Any] = {"initial": 8, "min_limit": 1, "max_limit": HTTP_POOL_SIZE}
+_limiters: Dict[str, AdaptiveLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(api_url: str) -> AdaptiveLimiter:
+    """获取（必要时创建）某个API地址的并发限制器"""
+    with _limiters_lock:
+        limiter = _limiters.get(api_url)
+        if limiter is None:
+            limiter = _limiters[api_url] = AdaptiveLimiter(**LIMITER_CONFIG)
+        return limiter
+
+
+def get_stats() -> Dict[str, Any]:
+    """返回进程级 LLM 调用统计、缓存命中、单飞合并情况与各API地址的当前并发上限"""
+    with _usage_lock:
+        stats = copy.deepcopy(_global_usage)
+    stats["by_model"] = usage_shares(stats)
+    with _cache_lock:
+        stats["cache"] = dict(_cache_stats, size=len(_cache), maxsize=_cache_config["maxsize"])
+    with _flight_lock:
+        leaders, followers = _flight_stats["leaders"], _flight_stats["followers"]
+        stats["single_flight"] = {
+            "leaders": leaders,
+            "followers": followers,
+            "in_flight": len(_flights),
+            "coalesced_ratio": round(followers / (leaders + followers), 4) if leaders + followers else 0.0,
+        }
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    stats["limits"] = {url: limiter.snapshot() for url, limiter in limiters.items()}
+    return stats
+
+
+def usage_shares(usage: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    为 by_model 统计补充档位（tier）以及 token 与耗时占比
+
+    Args:
+        usage: track_usage / get_stats 返回的统计字典
+
+    Returns:
+        {model: {..., "tier": "small", "token_share": 0.2, "latency_share": 0.1}}
+    """
+    tiers = {cfg["model"]: name for name, cfg in MODEL_TIERS.items()}
+    total_tokens = usage.get("total_tokens") or 0
+    total_latency = usage.get("latency") or 0.0
+    shares = {}
+    for model, item in (usage.get("by_model") or {}).items():
+        item = dict(item)
+        item["tier"] = tiers.get(model, "")
+        item["token_share"] = round(item["total_tokens"] / total_tokens, 4) if total_tokens else 0.0
+        item["latency_share"] = round(item["latency"] / total_latency, 4) if total_latency else 0.0
+        shares[model] = item
+    return shares
+
+
+@contextmanager
+def track_usage():
+    """
+    统计上下文内所有 LLM 调用的次数、token 用量与耗时
+
+    用法：
+        with track_usage() as usage:
+            tcm_sydrom_agent(case)
+        print(usage["calls"], usage["total_tokens"])
+
+    Yields:
+        统计字典：calls / errors / prompt_tokens / completion_tokens / total_tokens / latency /
+        coalesced（被单飞合并、未实际发出请求的调用数）/ by_model（按模型拆分的同名统计）
+    """
+    usage = _new_usage()
+    token = _usage_var.set(usage)
+    try:
+        yield usage
+    finally:
+        _usage_var.reset(token)
+
+
+def _record_usage(model: str, data: Optional[Dict[str, Any]], latency: float) -> None:
+    """将一次调用的 token 用量与耗时记入当前统计上下文（总计及按模型拆分）"""
+    tokens = (data or {}).get("usage") or {}
+    with _usage_lock:
+        for usage in (_global_usage, _usage_var.get()):
+            if usage is None:
+                continue
+            per_model = usage["by_model"].setdefault(model, {key: 0 for key in _USAGE_FIELDS})
+            for bucket in (usage, per_model):
+                bucket["calls"] += 1
+                bucket["latency"] += latency
+                if data is None:
+                    bucket["errors"] += 1
+                for key in ("prompt_tokens", "completion_tokens", "total_tokens"):
+                    bucket[key] += int(tokens.get(key) or 0)
+
+
+def _record_coalesced() -> None:
+    """记录一次被单飞合并（未实际发出 HTTP 请求）的调用"""
+    with _usage_lock:
+        for usage in (_global_usage, _usage_var.get()):
+            if usage is not None:
+                usage["coalesced"] += 1
+
+
+def _post_chat(api_url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    发送 chat/completions 请求，失败时抛出 RequestException
+
+    temperature=0 的请求经过单飞合并：若已有相同请求在进行中，则等待并共享其结果
+    （或异常），不再重复发送。只合并到同一通道或更高优先级通道的请求上，
+    避免交互请求跟随排在 batch 通道中的请求等待（优先级反转）。
+    """
+    if payload.get("temperature") != 0:
+        return _send_chat(api_url, payload)
+
+    lane = _lane_var.get()
+    base_key = _cache_key(api_url, payload)
+    key = f"{lane}:{base_key}"
+    joinable = sorted((name for name, cfg in LANES.items() if cfg["priority"] <= LANES[lane]["priority"]),
+                      key=lambda name: LANES[name]["priority"])
+    with _flight_lock:
+        flight = next((_flights[f"{name}:{base_key}"] for name in joinable if f"{name}:{base_key}" in _flights), None)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+            _flight_stats["leaders"] += 1
+        else:
+            flight.followers += 1
+            _flight_stats["followers"] += 1
+
+    if not leader:
+        flight.done.wait()
+        _record_coalesced()
+        if flight.error is not None:
+            raise flight.error
+        return flight.data
+
+    try:
+        flight.data = _send_chat(api_url, payload)
+        return flight.data
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _flight_lock:
+            del _flights[key]
+        flight.done.set()
+
+
+def _is_overload(error: BaseException) -> bool:
+    """判断异常是否为后端过载信号：429/5xx、超时或连接错误"""
+    if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+        return True
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def _send_chat(api_url: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """发送一次 chat/completions 请求并记录用量，失败时抛出 RequestException"""
+    headers = {"Content-Type": "application/json"}
+    limiter = get_limiter(api_url)
+    lane = _lane_var.get()
+    limiter.acquire(lane)
+    start = time.perf_counter()
+    data = None
+    overloaded = False
+    try:
+        resp = _session.post(api_url, headers=headers, json=payload, timeout=120)
+        resp.raise_for_status()
+        data = resp.json()
+        return data
+    except (requests.exceptions.RequestException, ValueError) as e:
+        overloaded = _is_overload(e)
+        raise
+    finally:
+        latency = time.perf_counter() - start
+        completion_tokens = int(((data or {}).get("usage") or {}).get("completion_tokens") or 0)
+        limiter.release(latency, overloaded=overloaded, completion_tokens=completion_tokens, lane=lane,
+                        model=payload.get("model", ""))
+        _record_usage(payload.get("model", ""), data, latency)
+        events.debug("llm.call", "{model} 耗时 {latency:.2f}s，输出 {completion_tokens} tokens",
+                     model=payload.get("model", ""), lane=lane, latency=latency,
+                     completion_tokens=completion_tokens, ok=data is not None)
+
+
+def _parse_json_content(content: str) -> Any:
+    """解析模型返回的JSON文本，失败时尝试从文本中提取JSON；找不到JSON时返回空字典"""
+    try:
+        return json.loads(content)
+    except json.JSONDecodeError:
+        # 尝试从文本中提取JSON
+        m = re.search(r"\{[\s\S]*\}", content)
+        if not m:
+            return {}
+        return json.loads(m.group(0))
 
 
 def call_llm(
@@ -17,7 +505,8 @@ def call_llm(
     model: str = DEFAULT_MODEL,
     max_tokens: int = 2000,
     temperature: float = 0.0,
-    response_format: Optional[Dict[str, str]] = None
+    response_format: Optional[Dict[str, str]] = None,
+    accept: Optional[Callable[[Any], bool]] = None
 ) -> Dict[str, Any]:
     """
     调用大模型API
@@ -29,6 +518,7 @@ def call_llm(
         max_tokens: 最大输出token数
         temperature: 温度参数
         response_format: 响应格式，如 {"type": "json_object"}
+        accept: 结果校验函数；提供时只缓存通过校验的结果，避免错误输出被后续相同请求复用
 
     Returns:
         解析后的JSON字典，如果解析失败返回空字典
@@ -47,32 +537,130 @@ def call_llm(
         # 默认使用JSON格式
         payload["response_format"] = {"type": "json_object"}
 
-    headers = {"Content-Type": "application/json"}
+    # temperature=0 的请求结果可复用
+    cache_key = _cache_key(api_url, payload) if temperature == 0 else None
+    if cache_key:
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            return cached
 
     try:
-        resp = requests.post(api_url, headers=headers, json=payload, timeout=120)
-        resp.raise_for_status()
-        data = resp.json()
+        data = _post_chat(api_url, payload)
         content = data.get("choices", [{}])[0].get("message", {}).get("content", "{}")
+        result = _parse_json_content(content)
 
-        # 尝试解析JSON
-        try:
-            return json.loads(content)
-        except json.JSONDecodeError:
-            # 尝试从文本中提取JSON
-            m = re.search(r"\{[\s\S]*\}", content)
-            if m:
-                return json.loads(m.group(0))
-            return {}
+        if cache_key and result and (accept is None or accept(result)):
+            _cache_put(cache_key, result)
+        return result
 
     except requests.exceptions.RequestException as e:
-        print(f"API请求失败: {e}")
+        events.error("llm.request_failed", "API请求失败: {error}", model=model, error=repr(e))
         return {}
     except json.JSONDecodeError as e:
-        print(f"JSON解析失败: {e}")
+        events.error("llm.parse_failed", "JSON解析失败: {error}", model=model, error=repr(e))
         return {}
 
 
+# 不支持 n 参数（返回的 choices 少于请求数或直接报错）的API地址
+_n_unsupported: set = set()
+_fanout_pool: Optional[ThreadPoolExecutor] = None
+_fanout_lock = threading.Lock()
+
+
+def _get_fanout_pool() -> ThreadPoolExecutor:
+    global _fanout_pool
+    with _fanout_lock:
+        if _fanout_pool is None:
+            _fanout_pool = ThreadPoolExecutor(max_workers=HTTP_POOL_SIZE, thread_name_prefix="llm-fanout")
+        return _fanout_pool
+
+
+def _rejects_n(error: BaseException) -> bool:
+    """判断请求失败是否因为后端不接受 n 参数（400 且错误信息提及 n）"""
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) != 400:
+        return False
+    return re.search(r"(?<![a-z_])n(?![a-z_])", (response.text or "").lower()) is not None
+
+
+def _choice_contents(data: Dict[str, Any]) -> List[str]:
+    return [c.get("message", {}).get("content", "") for c in data.get("choices", []) or []]
+
+
+def call_llm_candidates(
+    messages: List[Dict[str, str]],
+    n: int = 3,
+    api_url: str = DEFAULT_API_URL,
+    model: str = DEFAULT_MODEL,
+    max_tokens: int = 2000,
+    temperature: float = CANDIDATE_TEMPERATURE,
+    response_format: Optional[Dict[str, str]] = None
+) -> List[Dict[str, Any]]:
+    """
+    一次往返获取多个候选结果
+
+    优先使用 OpenAI 的 n 参数在一次请求中采样 n 个候选；若后端不支持 n
+    （报错或返回的 choices 不足），则以并行请求补齐，并记住该API地址后续直接并行。
+
+    Args:
+        messages: 消息列表
+        n: 候选数量
+        api_url: API地址
+        model: 模型名称
+        max_tokens: 每个候选的最大输出token数
+        temperature: 采样温度，需大于0以产生不同候选
+        response_format: 响应格式，默认 {"type": "json_object"}
+
+    Returns:
+        成功解析为JSON的候选列表（按返回顺序），可能少于 n 个
+    """
+    payload: Dict[str, Any] = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "response_format": response_format or {"type": "json_object"},
+    }
+
+    contents: List[str] = []
+    if n > 1 and api_url not in _n_unsupported:
+        try:
+            contents = _choice_contents(_post_chat(api_url, dict(payload, n=n)))
+            # 请求成功但 choices 不足，说明后端忽略了 n 参数
+            if len(contents) < n:
+                _n_unsupported.add(api_url)
+        except requests.exceptions.RequestException as e:
+            # 只有明确拒绝 n 参数（400 且提示 n）才记为不支持；超时/429/5xx 等临时错误下次仍尝试 n
+            if _rejects_n(e):
+                _n_unsupported.add(api_url)
+            events.warning("llm.n_failed", "API请求失败（n={n}），改为并行请求: {error}",
+                           model=model, n=n, error=repr(e))
+
+    missing = n - len(contents)
+    if missing > 0:
+        def _single() -> List[str]:
+            try:
+                return _choice_contents(_post_chat(api_url, payload))[:1]
+            except requests.exceptions.RequestException as e:
+                events.error("llm.request_failed", "API请求失败: {error}", model=model, error=repr(e))
+                return []
+
+        pool = _get_fanout_pool()
+        futures = [pool.submit(contextvars.copy_context().run, _single) for _ in range(missing)]
+        for f in futures:
+            contents.extend(f.result())
+
+    candidates = []
+    for content in contents:
+        try:
+            result = _parse_json_content(content)
+        except json.JSONDecodeError:
+            continue
+        if result:
+            candidates.append(result)
+    return candidates
+
+
 def call_llm_text(
     messages: List[Dict[str, str]],
     api_url: str = DEFAULT_API_URL,
@@ -100,13 +688,9 @@ def call_llm_text(
         "max_tokens": max_tokens,
     }
 
-    headers = {"Content-Type": "application/json"}
-
     try:
-        resp = requests.post(api_url, headers=headers, json=payload, timeout=120)
-        resp.raise_for_status()
-        data = resp.json()
+        data = _post_chat(api_url, payload)
         return data.get("choices", [{}])[0].get("message", {}).get("content", "")
     except requests.exceptions.RequestException as e:
-        print(f"API请求失败: {e}")
+        events.error("llm.request_failed", "API请求失败: {error}", model=model, error=repr(e))
         return ""
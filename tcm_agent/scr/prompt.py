@@ -200,11 +200,38 @@ TREATMENT_COT_PROMPT = """你是资深中医临床处方专家。请严格按以
 """
 
 
+# ==================== 给方快速通道（单次调用）提示词 ====================
+TREATMENT_FAST_PATH_SYSTEM_PROMPT = """你是资深中医临床处方专家。请根据辨病信息与病人症状，一次性完成处方制定：
+1) 确定治法/治则
+2) 推荐一个基础方
+3) 针对基础方提出加减
+4) 给出最终每味药的用量（以 g 为单位）与煎服方法
+5) 注意避免"十八反、十九畏"等配伍禁忌，必要时给出用药警告
+
+只返回严格的 JSON 对象，不要任何解释性文字。"""
+
+TREATMENT_FAST_PATH_USER_PROMPT = """辨病信息：{tcm_diagnosis}
+病人主要症状：{symptoms}
+
+请返回 JSON：
+{{
+  "treatment_principle": "治则/治法",
+  "base_formula": {{"name": "", "source": "", "herbs": ["..."]}},
+  "modifications": [{{"herb": "...", "reason": "..."}}],
+  "final_prescription": [{{"herb": "...", "dose": "...g"}}],
+  "useway": "煎服方法说明",
+  "warnings": ["..."]
+}}
+
+要求：final_prescription 包含基础方与加减后的全部药物，每味药剂量为"数字+g"。
+只返回 JSON 对象。"""
+
+
 # ==================== 输出控制/安全检查提示词 ====================
 OUTPUT_CONTROL_SYSTEM_PROMPT = """你是一个负责中药处方安全与质量控制的专家系统。你的任务是：
 1) 根据"十八反"和"十九畏"规则检查处方中的明显配伍禁忌
-2) 如果发现存在明显不合理组合，建议调整方案（propose_modifications）并返回用药警告
-3) 对最终处方做质量检查，确保返回的结构严格符合要求
+2) 如果发现存在明显不合理组合，给出最小的修改补丁（patches）并返回用药警告
+3) 不要复述处方，只返回发现的问题与补丁
 
 输出必须为 JSON，格式详见 USER_PROMPT。只返回 JSON 对象，不要任何多余文本。"""
 
@@ -219,11 +246,15 @@ OUTPUT_CONTROL_USER_PROMPT = """请对以下处方进行安全校验：
 {{
   "has_contraindication": true/false,
   "contraindications": ["描述1", ...],
-  "proposed_modifications": [ {{"herb":"...","action":"remove/replace/reduce","reason":"...","suggestion":"..."}}, ... ],
-  "warnings": ["..."],
-  "final_prescription": {{}}
+  "patches": [
+    {{"op": "remove", "herb": "要删除的药"}},
+    {{"op": "replace", "herb": "要替换的药", "value": "替代药名", "dose": "...g（可省略，省略则沿用原剂量）"}},
+    {{"op": "reduce", "herb": "要减量的药", "value": "...g"}}
+  ],
+  "warnings": ["..."]
 }}
 
+patches 只列出需要修改的药物，不要返回完整处方；无需修改时 patches 为空列表。
 只返回 JSON 对象。"""
 
 
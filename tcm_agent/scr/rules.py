@@ -0,0 +1,211 @@
+"""中药配伍规则模块 - 提供药名归一化与"十八反、十九畏"本地检查"""
+
+import re
+from typing import List, Iterable, Tuple
+
+
+# 炮制前缀，比较药名时去除（如"炒白芍"→"白芍"，"姜半夏"→"半夏"）
+# 产地前缀（川、北、南、淮、浙、明等）常是药名本身的一部分（川楝子、北豆根、明党参），
+# 不在此统一去除，只在 HERB_ALIASES 中逐个列出确为同一药物的道地药名
+HERB_PREFIXES = (
+    "麸炒", "盐炒", "酒炒", "醋炒", "土炒", "蜜炙", "炒", "麸", "蜜", "炙", "生", "蒸", "燀",
+    "姜", "制", "法", "清", "酒", "醋", "盐", "焦", "煅", "净",
+)
+
+# 同药异名与道地药名，归一为常用名
+HERB_ALIASES = {
+    "枸杞子": "枸杞",
+    "丹皮": "牡丹皮",
+    "苡仁": "薏苡仁",
+    "枣仁": "酸枣仁",
+    "栝楼": "瓜蒌",
+    "淮山药": "山药",
+    "怀山药": "山药",
+    "怀牛膝": "牛膝",
+    "淮小麦": "小麦",
+    "川黄连": "黄连",
+    "川黄柏": "黄柏",
+    "川厚朴": "厚朴",
+    "川续断": "续断",
+    "北柴胡": "柴胡",
+    "北五味子": "五味子",
+    "杭白芍": "白芍",
+    "杭菊花": "菊花",
+    "明天麻": "天麻",
+}
+
+# 十八反：(药组A, 药组B, 说明)，A 中任一药与 B 中任一药同用即为禁忌
+EIGHTEEN_INCOMPATIBLE: List[Tuple[Tuple[str, ...], Tuple[str, ...], str]] = [
+    (("甘草",), ("甘遂", "大戟", "海藻", "芫花"), "甘草反甘遂、大戟、海藻、芫花"),
+    (("乌头", "川乌", "草乌", "附子"), ("贝母", "瓜蒌", "天花粉", "半夏", "白蔹", "白及"),
+     "乌头反贝母、瓜蒌、半夏、白蔹、白及"),
+    (("藜芦",), ("人参", "党参", "沙参", "丹参", "玄参", "苦参", "细辛", "芍"), "藜芦反诸参、细辛、芍药"),
+]
+
+# 十九畏：(药组A, 药组B, 说明)
+NINETEEN_FEARS: List[Tuple[Tuple[str, ...], Tuple[str, ...], str]] = [
+    (("硫黄",), ("朴硝", "芒硝"), "硫黄畏朴硝"),
+    (("水银",), ("砒霜",), "水银畏砒霜"),
+    (("狼毒",), ("密陀僧",), "狼毒畏密陀僧"),
+    (("巴豆",), ("牵牛",), "巴豆畏牵牛"),
+    (("丁香",), ("郁金",), "丁香畏郁金"),
+    (("乌头", "川乌", "草乌"), ("犀角",), "川乌、草乌畏犀角"),
+    (("牙硝",), ("三棱",), "牙硝畏三棱"),
+    (("官桂", "肉桂"), ("赤石脂",), "官桂畏赤石脂"),
+    (("人参",), ("五灵脂",), "人参畏五灵脂"),
+]
+
+# 药名+剂量，如"北沙参30g"、"生甘草 6 g"
+_HERB_DOSE_RE = re.compile(r"([\u4e00-\u9fff]{1,8}?)\s*(\d+(?:\.\d+)?)\s*g")
+
+
+def normalize_herb(name: str) -> str:
+    """去除炮制前缀与空白，得到用于比较的药名"""
+    name = re.sub(r"\s+", "", str(name or ""))
+    changed = True
+    while changed:
+        changed = False
+        for prefix in HERB_PREFIXES:
+            if name.startswith(prefix) and len(name) - len(prefix) >= 2:
+                name = name[len(prefix):]
+                changed = True
+                break
+    return HERB_ALIASES.get(name, name)
+
+
+def parse_herbs(text: str) -> List[Tuple[str, float]]:
+    """从处方文本中解析 (药名, 剂量g) 列表，如"北沙参30g 麦冬15g" """
+    return [(m.group(1), float(m.group(2))) for m in _HERB_DOSE_RE.finditer(text or "")]
+
+
+def _matches(herb: str, group: Iterable[str]) -> bool:
+    return any(member in herb for member in group)
+
+
+def find_contraindications(herbs: Iterable[str]) -> List[str]:
+    """
+    检查药物列表中的"十八反、十九畏"配伍禁忌
+
+    Args:
+        herbs: 药名列表（可带炮制前缀）
+
+    Returns:
+        禁忌描述列表，如 ["甘草-海藻（十八反：甘草反甘遂、大戟、海藻、芫花）"]，无禁忌时为空列表
+    """
+    names = list(dict.fromkeys(normalize_herb(h) for h in herbs if h))
+    found = []
+    for rules, label in ((EIGHTEEN_INCOMPATIBLE, "十八反"), (NINETEEN_FEARS, "十九畏")):
+        for group_a, group_b, desc in rules:
+            for a in names:
+                if not _matches(a, group_a):
+                    continue
+                for b in names:
+                    if a != b and _matches(b, group_b):
+                        found.append(f"{a}-{b}（{label}：{desc}）")
+    return found
+
+
+# 单味药剂量合理范围（g），超出视为异常
+MIN_HERB_DOSE_G = 0.5
+MAX_HERB_DOSE_G = 120
+
+_DOSE_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*g\s*$")
+
+# 标准处方的必填文本字段
+_REQUIRED_TEXT_FIELDS = ("tcm_diagnosis", "treatment_principle", "base_formula", "useway")
+
+
+def parse_dose(dose) -> float:
+    """解析"15g"形式的剂量，格式不符时返回 -1"""
+    m = _DOSE_RE.match(str(dose or ""))
+    return float(m.group(1)) if m else -1.0
+
+
+def check_prescription(prescription: dict) -> List[str]:
+    """
+    本地校验标准处方（见 TREATMENT_OUTPUT_VALIDATION_PROMPT 中的 schema）
+
+    检查必填字段、final_prescription 中每味药的药名与剂量格式（"...g"）及范围、
+    重复药物（原药名相同），以及"十八反、十九畏"配伍禁忌。
+
+    Returns:
+        问题描述列表，为空表示校验通过
+    """
+    if not isinstance(prescription, dict):
+        return ["处方不是 JSON 对象"]
+
+    errors = []
+    for field in _REQUIRED_TEXT_FIELDS:
+        if not isinstance(prescription.get(field), str) or not prescription[field].strip():
+            errors.append(f"缺少字段 {field}")
+    if not isinstance(prescription.get("warnings", []), list):
+        errors.append("warnings 必须为列表")
+
+    items = prescription.get("final_prescription")
+    if not isinstance(items, list) or not items:
+        errors.append("final_prescription 为空")
+        return errors
+
+    herbs = []
+    for item in items:
+        if not isinstance(item, dict) or not item.get("herb"):
+            errors.append(f"药物条目格式错误: {item}")
+            continue
+        herb = item["herb"]
+        dose = parse_dose(item.get("dose"))
+        if dose < 0:
+            errors.append(f"{herb} 剂量格式错误: {item.get('dose')}")
+        elif not MIN_HERB_DOSE_G <= dose <= MAX_HERB_DOSE_G:
+            errors.append(f"{herb} 剂量超出范围: {item.get('dose')}")
+        # 重复药物按原药名判断：炮制/产地不同的同类药（如炒白术与生白术）可合用
+        name = re.sub(r"\s+", "", str(herb))
+        if name in herbs:
+            errors.append(f"重复药物: {herb}")
+        herbs.append(name)
+
+    errors.extend(f"配伍禁忌: {c}" for c in find_contraindications(item["herb"] for item in items
+                                                                if isinstance(item, dict) and item.get("herb")))
+    return errors
+
+
+def apply_patches(prescription: dict, patches: list) -> tuple:
+    """
+    将安全校验返回的补丁应用到标准处方的 final_prescription 上（不修改原处方）
+
+    支持的补丁：
+        {"op": "remove", "herb": "海藻"}
+        {"op": "replace", "herb": "半夏", "value": "陈皮", "dose": "9g"}   # dose 可省略
+        {"op": "reduce", "herb": "附子", "value": "6g"}                    # 新剂量须小于原剂量
+
+    Returns:
+        (修改后的处方, 已应用的补丁列表, 未能应用的补丁列表)
+    """
+    patched = dict(prescription)
+    items = [dict(item) for item in prescription.get("final_prescription") or [] if isinstance(item, dict)]
+    applied, rejected = [], []
+
+    for patch in patches or []:
+        if not isinstance(patch, dict):
+            rejected.append(patch)
+            continue
+        op, target = patch.get("op"), normalize_herb(patch.get("herb", ""))
+        index = next((i for i, item in enumerate(items) if normalize_herb(item.get("herb", "")) == target), None)
+        if index is None or not target:
+            rejected.append(patch)
+            continue
+
+        if op == "remove":
+            items.pop(index)
+        elif op == "replace" and patch.get("value"):
+            items[index]["herb"] = patch["value"]
+            if parse_dose(patch.get("dose")) > 0:
+                items[index]["dose"] = patch["dose"]
+        elif op == "reduce" and 0 < parse_dose(patch.get("value")) < parse_dose(items[index].get("dose")):
+            items[index]["dose"] = patch["value"]
+        else:
+            rejected.append(patch)
+            continue
+        applied.append(patch)
+
+    patched["final_prescription"] = items
+    return patched, applied, rejected
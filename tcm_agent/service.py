@@ -0,0 +1,207 @@
+"""
+中医智能体常驻 HTTP 服务
+
+在进程内常驻 scr/agent.py 中的各智能体，复用 HTTP 连接池、LLM 结果缓存与
+预构建的提示词/规则表，供上游 EMR 系统以较低的单次开销并发调用。
+
+接口（请求与响应均为 JSON）：
+- POST /extract    请求体为病例字典（同 pipeline.py 中的 case），返回症状结构
+- POST /diagnose   请求体为症状结构，返回 {"think", "tcm_diagnosis"}
+- POST /treat      请求体为 {"symptoms": {...}, "tcm_diagnosis": {...}}，返回结构化处方
+- POST /pipeline   请求体为病例字典，返回 {"symptoms", "diagnosis", "treatment"}
+- GET  /health     存活检查
+- GET  /metrics    各接口请求数/耗时、LLM 调用统计（含各优先级通道排队耗时）、给方快速通道命中率与事件日志统计
+
+请求头 X-Priority-Lane 指定 LLM 调用的优先级通道（interactive / batch），默认 interactive；
+批量任务应设为 batch，使临床医生的交互请求优先获得并发名额。
+
+用法：
+    python service.py --host 0.0.0.0 --port 8000
+"""
+
+import sys
+import os
+import json
+import time
+import argparse
+import itertools
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# 添加 scr 目录到路径
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scr'))
+
+from agent import tcm_sydrom_agent
+from agent import tcm_diagnosis_agent
+from agent import tcm_treatment_agent
+from agent import get_fast_path_stats
+from llm import LANES, DEFAULT_LANE, track_usage, priority_lane, enable_cache, get_stats
+from events import LEVELS, configure, event_tags, get_event_stats
+
+
+# 服务级给方选项（由命令行参数设置）
+TREATMENT_OPTIONS = {"fast_path": False}
+
+
+def _extract(body: dict) -> dict:
+    return tcm_sydrom_agent(body)
+
+
+def _diagnose(body: dict) -> dict:
+    return tcm_diagnosis_agent(body)
+
+
+def _treat(body: dict) -> dict:
+    return tcm_treatment_agent(body.get("symptoms", {}), body.get("tcm_diagnosis", {}), **TREATMENT_OPTIONS)
+
+
+def _pipeline(body: dict) -> dict:
+    symptoms = tcm_sydrom_agent(body)
+    diagnosis = tcm_diagnosis_agent(symptoms)
+    treatment = tcm_treatment_agent(symptoms, diagnosis, **TREATMENT_OPTIONS)
+    return {"symptoms": symptoms, "diagnosis": diagnosis, "treatment": treatment}
+
+
+ROUTES = {
+    "/extract": _extract,
+    "/diagnose": _diagnose,
+    "/treat": _treat,
+    "/pipeline": _pipeline,
+}
+
+
+class ServiceMetrics:
+    """各接口的请求计数、错误数、耗时与 LLM 用量（线程安全）"""
+
+    def __init__(self):
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self.in_flight = 0
+
+    def begin(self) -> None:
+        with self._lock:
+            self.in_flight += 1
+
+    def end(self, path: str, latency: float, ok: bool, usage: dict) -> None:
+        with self._lock:
+            self.in_flight -= 1
+            stats = self._endpoints.setdefault(path, {
+                "requests": 0, "errors": 0, "latency": 0.0, "max_latency": 0.0,
+                "llm_calls": 0, "total_tokens": 0,
+            })
+            stats["requests"] += 1
+            stats["errors"] += 0 if ok else 1
+            stats["latency"] += latency
+            stats["max_latency"] = max(stats["max_latency"], latency)
+            stats["llm_calls"] += usage.get("calls", 0)
+            stats["total_tokens"] += usage.get("total_tokens", 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            endpoints = {}
+            for path, stats in self._endpoints.items():
+                item = dict(stats)
+                item["latency"] = round(stats["latency"], 3)
+                item["max_latency"] = round(stats["max_latency"], 3)
+                item["avg_latency"] = round(stats["latency"] / stats["requests"], 3) if stats["requests"] else 0.0
+                endpoints[path] = item
+            return {
+                "uptime": round(time.time() - self.started, 1),
+                "in_flight": self.in_flight,
+                "endpoints": endpoints,
+            }
+
+
+METRICS = ServiceMetrics()
+
+# 请求编号，作为事件日志中的 case 标签
+_request_ids = itertools.count(1)
+
+
+class TCMRequestHandler(BaseHTTPRequestHandler):
+    """将 HTTP 请求分发到对应的智能体"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        # 访问日志由 /metrics 统计代替，避免每个请求都写 stderr
+        pass
+
+    def _send_json(self, status: int, obj) -> None:
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok", "uptime": round(time.time() - METRICS.started, 1)})
+        elif self.path == "/metrics":
+            self._send_json(200, {"service": METRICS.snapshot(), "llm": get_stats(), "fast_path": get_fast_path_stats(),
+                                  "events": get_event_stats()})
+        else:
+            self._send_json(404, {"error": f"未知接口: {self.path}"})
+
+    def do_POST(self):
+        handler = ROUTES.get(self.path)
+        if handler is None:
+            self._send_json(404, {"error": f"未知接口: {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(body, dict):
+                raise ValueError("请求体必须为 JSON 对象")
+        except ValueError as e:
+            self._send_json(400, {"error": f"请求体解析失败: {e}"})
+            return
+
+        lane = self.headers.get("X-Priority-Lane") or DEFAULT_LANE
+        if lane not in LANES:
+            self._send_json(400, {"error": f"未知的优先级通道: {lane}，可选: {list(LANES)}"})
+            return
+
+        METRICS.begin()
+        start = time.perf_counter()
+        ok = False
+        with track_usage() as usage, priority_lane(lane), event_tags(case=f"req-{next(_request_ids)}"):
+            try:
+                result = handler(body)
+                ok = True
+            except Exception as e:
+                result = {"error": repr(e)}
+        METRICS.end(self.path, time.perf_counter() - start, ok, usage)
+        self._send_json(200 if ok else 500, result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="中医智能体 HTTP 服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=8000, help="监听端口")
+    parser.add_argument("--cache-size", type=int, default=4096, help="LLM 结果缓存条目数，0 表示关闭")
+    parser.add_argument("--fast-path", action="store_true", help="给方先尝试单次调用的快速通道，失败再回退到 ReAct")
+    parser.add_argument("--log", default=None, help="事件日志输出路径（JSONL，带 case/stage/cycle/step 标签）")
+    parser.add_argument("--log-level", default="info", choices=list(LEVELS), help="事件日志最低级别")
+    parser.add_argument("--quiet", action="store_true", help="不在控制台输出过程信息")
+    args = parser.parse_args()
+
+    configure(args.log, args.log_level, args.quiet)
+    TREATMENT_OPTIONS["fast_path"] = args.fast_path
+    enable_cache(args.cache_size)
+    server = ThreadingHTTPServer((args.host, args.port), TCMRequestHandler)
+    server.daemon_threads = True
+    print(f"中医智能体服务已启动: http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()